@@ -1,29 +1,51 @@
 import requests
+import numpy as np
 import pandas as pd
-import schedule
+import pyarrow as pa
+import pyarrow.parquet as pq
+import asyncio
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
+from geopy.extra.rate_limiter import RateLimiter
 import json
 import os
 from dotenv import load_dotenv
 import hashlib
+import hmac
+import secrets
 import io
+import csv
+import gzip
 import folium
-from PIL import Image
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 import tempfile
+import shutil
 import uuid
+import sqlite3
+import threading
+import queue
+import heapq
+import atexit
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+from bisect import bisect_right
+from collections import OrderedDict, deque
 
 # Carica le variabili d'ambiente dal file .env
 load_dotenv()
 
-# Configurazione
+# Configurazione (veicolo singolo, usata quando non è configurata una flotta)
 unit_id = os.getenv("UNIT_ID")
 token = os.getenv("TARGA_TOKEN")
-base_url = f"https://fleet.targatelematics.com/t2/api/followUnit/recentPositions/{unit_id}/{token}/30"
+TARGA_API_URL = "https://fleet.targatelematics.com/t2/api/followUnit/recentPositions"
 
 # Configurazione Telegram
 #BOT CROLLA
@@ -33,51 +55,648 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
 
+# Limiti di invio di Telegram: messaggi al secondo in totale e al minuto per ciascuna chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "20"))
+# Thread che svuotano la coda degli invii, tentativi massimi e timeout (secondi) di ogni richiesta
+TELEGRAM_SEND_WORKERS = max(int(os.getenv("TELEGRAM_SEND_WORKERS", "4")), 1)
+TELEGRAM_MAX_RETRIES = max(int(os.getenv("TELEGRAM_MAX_RETRIES", "5")), 1)
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", "30"))
+# Metodi che passano davanti agli altri nella coda: la risposta ai pulsanti non attende gli upload
+TELEGRAM_PRIORITY_METHODS = ("answerCallbackQuery", "editMessageReplyMarkup")
+
 # Token di autorizzazione
 auth_token = os.getenv("AUTH_TOKEN")
 
-headers = {
-    "Authorization": auth_token,
-    "Accept": "*/*",
-    "User-Agent": "Mozilla/5.0",
-    "X-Requested-With": "XMLHttpRequest"
-}
+# Modalità flotta: file JSON con la lista dei veicoli (unit_id, targa_token, auth_token, chat_id, name)
+FLEET_FILE = os.getenv("FLEET_FILE")
+# Cartella con i dati dei veicoli della flotta (una sottocartella per veicolo)
+FLEET_DATA_DIR = os.getenv("FLEET_DATA_DIR", "fleet_data")
+# Numero massimo di veicoli interrogati in parallelo
+FLEET_MAX_WORKERS = max(int(os.getenv("FLEET_MAX_WORKERS", "16")), 1)
 
-# Percorso dei file
+# Percorso dei file (in modalità flotta sono nella cartella di ciascun veicolo)
 csv_file = "positions_log.csv"
 txt_file = "positions_log.txt"
 map_file = "last_position_map.png"
 route_map_file_5 = "route_map_5.png"
 route_map_file_20 = "route_map_20.png"
 interactive_map_file = "last_position_map.html"  # File per la mappa interattiva
+db_file = "positions.db"  # Archivio append-only delle posizioni (SQLite in modalità WAL)
+delta_csv_file = "positions_new.csv"  # Solo le posizioni aggiunte dall'ultimo invio (modalità delta)
+delta_txt_file = "positions_new.txt"
+archive_dir = "archive"  # Segmenti giornalieri compressi dell'archivio (modalità archive)
+history_dir = "history"  # Storico colonnare in Parquet, una partizione per giorno
+
+# Colonne del registro posizioni (stesso ordine del CSV esportato)
+POSITION_COLUMNS = [
+    "timestamp", "lat", "lon", "speed", "mileage", "description",
+    "battery", "fix", "hdop", "via", "comune", "provincia"
+]
+
+# Schema dello storico colonnare: timestamp in millisecondi epoch (UTC) e coordinate in float64
+HISTORY_SCHEMA = pa.schema([
+    ("ts", pa.int64()),
+    ("timestamp", pa.string()),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("speed", pa.float32()),
+    ("mileage", pa.float64()),
+    ("battery", pa.float32()),
+    ("hdop", pa.float32()),
+    ("description", pa.string()),
+    ("fix", pa.string()),
+    ("via", pa.string()),
+    ("comune", pa.string()),
+    ("provincia", pa.string())
+])
+
+# Numero di posizioni recenti tenute in memoria (deve coprire la mappa da 20 posizioni)
+RECENT_POSITIONS_SIZE = max(int(os.getenv("RECENT_POSITIONS_SIZE", "100")), 20)
+
+# Veicoli monitorati { unit_id: Unit }
+units = {}
+# Chat Telegram già verificate con il messaggio di test
+verified_chats = set()
+verified_chats_lock = threading.Lock()
+# Sessione HTTP condivisa per l'API Targa: le connessioni vengono riutilizzate tra i veicoli
+targa_session = requests.Session()
+targa_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=FLEET_MAX_WORKERS))
+# Intervalli (secondi) tra i check dei veicoli e gli invii dei file
+POLL_INTERVAL_SECONDS = int(os.getenv("POLL_INTERVAL_SECONDS", "300"))
+FILES_INTERVAL_SECONDS = int(os.getenv("FILES_INTERVAL_SECONDS", "3600"))
+# Istantanea dello stato in memoria (contatori, buffer, viaggi, cadenza dei file) per il riavvio a caldo
+RUNTIME_SNAPSHOT_FILE = os.getenv("RUNTIME_SNAPSHOT_FILE", "runtime_state.json")
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "60"))
+# Intervallo (secondi) tra due stampe delle statistiche di servizio nel log (0 = disattivate)
+STATS_INTERVAL_SECONDS = int(os.getenv("STATS_INTERVAL_SECONDS", "3600"))
+# File di riepilogo: "full" (archivio completo), "delta" (solo le posizioni aggiunte dall'ultimo invio)
+# o "archive" (CSV compressi giornalieri, solo i giorni con nuove posizioni)
+FILES_EXPORT_MODE = os.getenv("FILES_EXPORT_MODE", "full")
+# Limiti del polling adattivo: più frequente in movimento, più rado da fermo o senza novità
+POLL_MIN_INTERVAL_SECONDS = int(os.getenv("POLL_MIN_INTERVAL_SECONDS", "60"))
+POLL_MAX_INTERVAL_SECONDS = max(int(os.getenv("POLL_MAX_INTERVAL_SECONDS", "1800")), POLL_MIN_INTERVAL_SECONDS)
+# Soglie per considerare il veicolo in movimento: velocità (km/h) o distanza (metri) dall'ultima posizione
+STATIONARY_SPEED_KMH = float(os.getenv("STATIONARY_SPEED_KMH", "3"))
+STATIONARY_DISTANCE_M = float(os.getenv("STATIONARY_DISTANCE_M", "50"))
+# Segmentazione in viaggi: durata minima di una sosta, pausa tra due posizioni che chiude il viaggio,
+# distanza minima perché un movimento sia un viaggio (sotto è rumore del GPS) e viaggi tenuti in memoria
+TRIP_STOP_MIN_SECONDS = int(os.getenv("TRIP_STOP_MIN_SECONDS", "300"))
+TRIP_GAP_SECONDS = int(os.getenv("TRIP_GAP_SECONDS", "900"))
+TRIP_MIN_DISTANCE_M = float(os.getenv("TRIP_MIN_DISTANCE_M", "200"))
+TRIPS_HISTORY_SIZE = int(os.getenv("TRIPS_HISTORY_SIZE", "1000"))
+# Aggiornamenti richiesti a Telegram: pulsanti e comandi (da chat, gruppi e canali)
+TELEGRAM_ALLOWED_UPDATES = ["callback_query", "message", "channel_post"]
+# Durata massima (secondi) di una richiesta getUpdates in long polling
+TELEGRAM_LONG_POLL_SECONDS = int(os.getenv("TELEGRAM_LONG_POLL_SECONDS", "50"))
+# Attesa massima (secondi) tra due tentativi di getUpdates dopo errori consecutivi
+TELEGRAM_UPDATES_MAX_BACKOFF = int(os.getenv("TELEGRAM_UPDATES_MAX_BACKOFF", "300"))
+# Ricezione dei pulsanti: "polling" (getUpdates in long polling) o "webhook" (Telegram invia gli aggiornamenti)
+TELEGRAM_UPDATES_MODE = os.getenv("TELEGRAM_UPDATES_MODE", "polling")
+# Webhook: URL pubblico registrato su Telegram (vuoto = nessuna registrazione, es. test locali o proxy già configurato),
+# indirizzo e porta del server locale e segreto verificato su ogni richiesta
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_HOST = os.getenv("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT = int(os.getenv("TELEGRAM_WEBHOOK_PORT", "8443"))
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+webhook_server = None
+# Pool di thread separati per i check, per rendering e invii, e per i pulsanti:
+# un rendering lento non blocca né i check né la gestione dei pulsanti
+fleet_executor = ThreadPoolExecutor(max_workers=FLEET_MAX_WORKERS, thread_name_prefix="fetch")
+notify_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="notify")
+callback_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="callback")
+updates_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="updates")
+# Un solo thread per il completamento degli indirizzi: attende il geocoding (1/s) senza occupare gli altri pool
+address_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="address")
+# Task in background ancora in esecuzione (riferimenti per evitare che vengano raccolti)
+background_tasks = set()
+
+# Numero di browser headless tenuti sempre avviati per il rendering delle mappe
+RENDERER_POOL_SIZE = max(int(os.getenv("RENDERER_POOL_SIZE", "1")), 1)
+# Tempo massimo (secondi) di attesa per un singolo rendering
+RENDER_JOB_TIMEOUT = float(os.getenv("RENDER_JOB_TIMEOUT", "60"))
+# Coda dei rendering (HTML in ingresso, PNG in uscita) e thread del pool
+render_queue = queue.Queue()
+renderer_threads = []
+renderer_lock = threading.Lock()
+
+# Backend predefinito per le immagini delle mappe: "browser" (Chrome headless) o "static" (Pillow)
+MAP_RENDER_BACKEND = os.getenv("MAP_RENDER_BACKEND", "browser")
+# Dimensioni delle immagini delle mappe e stile delle tile
+MAP_IMAGE_SIZE = (800, 600)
+MAP_TILES = "CartoDB positron"
+TILE_SIZE = 256
+TILE_URLS = {
+    "CartoDB positron": "https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png"
+}
+TILE_ATTRIBUTION = "© OpenStreetMap contributors © CARTO"
+# Sessione e thread condivisi per scaricare le tile del renderer statico
+tile_session = requests.Session()
+tile_session.headers.update({"User-Agent": "tracker_app"})
+tile_executor = ThreadPoolExecutor(max_workers=8)
+# Font delle etichette orarie (caricato al primo utilizzo)
+label_font = None
+
+# Livello di dettaglio delle mappe di percorso: tolleranza (pixel) della semplificazione del tracciato,
+# distanza minima (pixel) tra due marker e numero massimo di marker e di punti del tracciato
+ROUTE_SIMPLIFY_TOLERANCE_PX = float(os.getenv("ROUTE_SIMPLIFY_TOLERANCE_PX", "1.5"))
+ROUTE_MARKER_SPACING_PX = float(os.getenv("ROUTE_MARKER_SPACING_PX", "24"))
+ROUTE_MAX_MARKERS = int(os.getenv("ROUTE_MAX_MARKERS", "150"))
+ROUTE_MAX_POINTS = int(os.getenv("ROUTE_MAX_POINTS", "2000"))
+# Finestra predefinita (ore) del comando /percorso
+ROUTE_WINDOW_DEFAULT_HOURS = int(os.getenv("ROUTE_WINDOW_DEFAULT_HOURS", "24"))
+
+# Cache dei rendering indirizzata per contenuto: stessa descrizione della mappa = stessa immagine
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_MAX_FILES = int(os.getenv("RENDER_CACHE_MAX_FILES", "500"))
+render_cache_lock = threading.Lock()
+
+# Cache locale delle tile (chiave: stile, z, x, y) con limite di dimensione ed evizione LRU
+tile_cache_file = "tile_cache.db"
+TILE_CACHE_MAX_BYTES = int(float(os.getenv("TILE_CACHE_MAX_MB", "200")) * 1024 * 1024)
+# Porta del server locale che serve le tile al browser di rendering (0 = porta libera casuale)
+TILE_SERVER_PORT = int(os.getenv("TILE_SERVER_PORT", "0"))
+tile_cache_conn = None
+tile_cache_size = 0
+tile_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+tile_cache_lock = threading.Lock()
+tile_server = None
+
+# Database di stato condiviso (cache e dati di servizio)
+state_db_file = "tracker_state.db"
+state_db_conn = None
+state_db_lock = threading.RLock()
+
+# Cache del reverse geocoding, indicizzata per cella geohash
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Precisione del geohash: 8 caratteri = celle di circa 38 x 19 metri
+GEOCODE_CACHE_PRECISION = int(os.getenv("GEOCODE_CACHE_PRECISION", "8"))
+# Durata di validità di un indirizzo in cache (giorni)
+GEOCODE_CACHE_TTL = float(os.getenv("GEOCODE_CACHE_TTL_DAYS", "30")) * 86400
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "10000"))
+# Posizioni senza indirizzo completate al massimo a ogni invio dei file (il geocoding è limitato a 1/s)
+# e tempo massimo (secondi) dedicato a ogni veicolo per ciclo
+ADDRESS_BACKFILL_LIMIT = int(os.getenv("ADDRESS_BACKFILL_LIMIT", "300"))
+ADDRESS_BACKFILL_SECONDS = float(os.getenv("ADDRESS_BACKFILL_SECONDS", "60"))
+# Intervallo minimo tra due richieste a Nominatim (policy: una al secondo)
+NOMINATIM_MIN_DELAY = 1.0
+geocode_cache = OrderedDict()  # { cella: (indirizzo, creato_il) } in ordine LRU
+geocode_cache_loaded = False
+geocode_cache_lock = threading.Lock()
+reverse_geocoder = None
+reverse_geocoder_lock = threading.Lock()
+
+# Tempo massimo (secondi) di attesa del caricamento delle tile prima dello screenshot
+RENDER_TILES_TIMEOUT = float(os.getenv("RENDER_TILES_TIMEOUT", "10"))
+# Pausa dopo il caricamento per lasciare terminare l'animazione di fade-in delle tile
+RENDER_SETTLE_SECONDS = float(os.getenv("RENDER_SETTLE_SECONDS", "0.25"))
+# Metriche dei tempi di attesa del rendering
+render_metrics = {"renders": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0, "wait_last": 0.0}
+render_metrics_lock = threading.Lock()
+
+# Vero quando tutti i layer di tile Leaflet della pagina hanno emesso l'evento "load"
+# (Leaflet azzera lo stato di caricamento del layer nello stesso momento in cui emette "load")
+TILES_READY_SCRIPT = """
+if (document.readyState !== 'complete') { return false; }
+var layers = [];
+for (var key in window) {
+    if (key.indexOf('tile_layer_') === 0 && window[key] && window[key]._tiles !== undefined) {
+        layers.push(window[key]);
+    }
+}
+for (var i = 0; i < layers.length; i++) {
+    var loading = layers[i].isLoading ? layers[i].isLoading() : layers[i]._loading;
+    if (loading) { return false; }
+}
+return true;
+"""
+
+# Formato delle mappe HTML interattive: "folium" (pagina completa di folium) o "compact"
+# (posizioni salvate una sola volta come polyline codificate, marker ed etichette creati nel browser)
+INTERACTIVE_MAP_MODE = os.getenv("INTERACTIVE_MAP_MODE", "compact")
+LEAFLET_VERSION = "1.9.3"
 
-# Flag per tenere traccia del primo avvio
-primo_avvio = True
-# Hash dell'ultimo invio
-last_sent_hash = None
-# Contatore per tracciare le richieste (invio ogni 12 check)
-check_counter = 0
-# Flag per indicare se ci sono stati aggiornamenti dall'ultimo invio
-updates_since_last_send = False
-# Timestamp dell'ultima generazione delle mappe di percorso
-last_route_map_generation = 0
-
-# Dizionario per tenere traccia degli ultimi callback_data generati
-route_callbacks = {}
-# Insieme per tenere traccia dei callback in elaborazione (evita duplicati)
+# Pagina della mappa compatta: __DATA__ è sostituito dai layer raggruppati per stile (formato colonnare)
+COMPACT_MAP_TEMPLATE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@__LEAFLET__/dist/leaflet.css">
+<script src="https://cdn.jsdelivr.net/npm/leaflet@__LEAFLET__/dist/leaflet.js"></script>
+<style>html,body,#map{height:100%;margin:0}.l{font-size:10pt;color:#000;background:#fff;border:1px solid #000;border-radius:3px;padding:1px 3px;text-align:center;white-space:nowrap}</style>
+</head><body><div id="map"></div><script>
+var D=__DATA__;
+function dec(s){var p=[],i=0,a=0,o=0;while(i<s.length){for(var k=0;k<2;k++){var r=0,h=0,b;do{b=s.charCodeAt(i++)-63;r|=(b&31)<<h;h+=5}while(b>=32);var d=r&1?~(r>>1):r>>1;if(k)o+=d;else a+=d}p.push([a/1e5,o/1e5])}return p}
+var m=L.map('map').setView(D.c,D.z);L.tileLayer(D.t,{attribution:D.a}).addTo(m);
+D.g.forEach(function(g){var p=dec(g.p);
+if(g.k=='p')L.polyline(p,{color:g.s[0],weight:g.s[1],opacity:g.s[2]}).addTo(m);
+else p.forEach(function(q,i){
+if(g.k=='m'){var c=L.circleMarker(q,{radius:g.s[0],color:g.s[1],fillColor:g.s[1],fill:true,fillOpacity:g.s[2]}).addTo(m);if(g.h&&g.h[i])c.bindPopup(g.h[i])}
+else if(g.k=='c')L.circle(q,{radius:g.r[i],color:g.s[0],fill:true,fillOpacity:g.s[1]}).addTo(m);
+else L.marker(q,{icon:L.divIcon({className:'',iconSize:[60,20],iconAnchor:[30,-10],html:'<div class="l">'+g.x[i]+'</div>'})}).addTo(m)})});
+</script></body></html>
+"""
+
+# Registro dei pulsanti: validità (giorni), voci tenute in memoria per registro e voci massime salvate
+CALLBACK_TTL = float(os.getenv("CALLBACK_TTL_DAYS", "30")) * 24 * 3600
+CALLBACK_MEMORY_SIZE = int(os.getenv("CALLBACK_MEMORY_SIZE", "1000"))
+CALLBACK_MAX_ENTRIES = int(os.getenv("CALLBACK_MAX_ENTRIES", "50000"))
+
+class CallbackRegistry:
+    """Dizionario dei pulsanti salvato in tracker_state.db: sopravvive ai riavvii, scade dopo CALLBACK_TTL
+    e tiene in memoria solo le voci usate più di recente (le altre vengono lette per chiave quando servono)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.cache = OrderedDict()  # { chiave: (valore, created_at) } in ordine LRU
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def _key(self, key):
+        # Le chiavi composte (chat, messaggio) vengono salvate come JSON
+        return json.dumps(list(key)) if isinstance(key, tuple) else str(key)
+
+    def _remember(self, key, value, created_at):
+        self.cache[key] = (value, created_at)
+        self.cache.move_to_end(key)
+        while len(self.cache) > CALLBACK_MEMORY_SIZE:
+            self.cache.popitem(last=False)
+
+    def get(self, key, default=None):
+        stored_key = self._key(key)
+        expired_before = time.time() - CALLBACK_TTL
+        with self.lock:
+            if stored_key in self.cache:
+                value, created_at = self.cache[stored_key]
+                # Stessa scadenza della lettura dal database: una voce in memoria non allunga la validità
+                if created_at < expired_before:
+                    del self.cache[stored_key]
+                    return default
+                self.cache.move_to_end(stored_key)
+                return value
+        conn = get_state_db()
+        with state_db_lock:
+            row = conn.execute(
+                "SELECT value, created_at FROM callbacks WHERE registry = ? AND key = ? AND created_at >= ?",
+                (self.name, stored_key, expired_before)
+            ).fetchone()
+        if row is None:
+            return default
+        value = json.loads(row[0])
+        with self.lock:
+            self._remember(stored_key, value, row[1])
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        stored_key = self._key(key)
+        created_at = time.time()
+        with self.lock:
+            self._remember(stored_key, value, created_at)
+            self.writes += 1
+            purge = self.writes % 100 == 0
+        conn = get_state_db()
+        with state_db_lock:
+            conn.execute(
+                "INSERT OR REPLACE INTO callbacks (registry, key, value, created_at) VALUES (?, ?, ?, ?)",
+                (self.name, stored_key, json.dumps(value), created_at)
+            )
+            conn.commit()
+        if purge:
+            purge_callbacks()
+
+    def __delitem__(self, key):
+        stored_key = self._key(key)
+        with self.lock:
+            self.cache.pop(stored_key, None)
+        conn = get_state_db()
+        with state_db_lock:
+            conn.execute("DELETE FROM callbacks WHERE registry = ? AND key = ?", (self.name, stored_key))
+            conn.commit()
+
+def purge_callbacks():
+    """Rimuove i pulsanti scaduti e, oltre CALLBACK_MAX_ENTRIES, i più vecchi (query sull'indice per data)"""
+    conn = get_state_db()
+    with state_db_lock:
+        conn.execute("DELETE FROM callbacks WHERE created_at < ?", (time.time() - CALLBACK_TTL,))
+        conn.execute("""
+            DELETE FROM callbacks WHERE created_at <= (
+                SELECT created_at FROM callbacks ORDER BY created_at DESC LIMIT 1 OFFSET ?
+            )
+        """, (CALLBACK_MAX_ENTRIES,))
+        conn.commit()
+
+# Pulsanti delle mappe di percorso
+route_callbacks = CallbackRegistry("route")  # { callback_data: {"num_positions": num, "unit_id": id} }
+# Insieme per tenere traccia dei callback in elaborazione (evita duplicati tra thread e webhook)
 processing_callbacks = set()
-# Dizionario per tenere traccia dei messaggi e relativi pulsanti
-message_buttons = {}  # { message_id: { callback_data: num_positions } }
-# Dizionario per tenere traccia delle richieste di mappe HTML
-html_map_callbacks = {}  # { callback_data: {"file": file_path, "type": "position/route", "num_positions": num} }
+processing_callbacks_lock = threading.Lock()
+# Pulsanti ancora presenti in ogni messaggio
+message_buttons = CallbackRegistry("message")  # { (chat_id, message_id): { callback_data: num_positions } }
+# Pulsanti delle mappe HTML
+html_map_callbacks = CallbackRegistry("html_map")  # { callback_data: {"file": file_path, "type": "position/route/window", ...} }
+
+class Unit:
+    """Configurazione, stato e archivio di un singolo veicolo"""
+    
+    def __init__(self, unit_id, targa_token, auth_token, chat_id, name=None, data_dir=""):
+        self.unit_id = str(unit_id)
+        self.name = name or self.unit_id
+        self.chat_id = chat_id
+        self.base_url = f"{TARGA_API_URL}/{unit_id}/{targa_token}/30"
+        self.headers = {
+            "Authorization": auth_token,
+            "Accept": "*/*",
+            "User-Agent": "Mozilla/5.0",
+            "X-Requested-With": "XMLHttpRequest"
+        }
+        
+        # Percorso dei file del veicolo
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.csv_file = os.path.join(data_dir, csv_file)
+        self.txt_file = os.path.join(data_dir, txt_file)
+        self.map_file = os.path.join(data_dir, map_file)
+        self.route_map_file_5 = os.path.join(data_dir, route_map_file_5)
+        self.route_map_file_20 = os.path.join(data_dir, route_map_file_20)
+        self.interactive_map_file = os.path.join(data_dir, interactive_map_file)
+        self.db_file = os.path.join(data_dir, db_file)
+        self.delta_csv_file = os.path.join(data_dir, delta_csv_file)
+        self.delta_txt_file = os.path.join(data_dir, delta_txt_file)
+        self.archive_dir = os.path.join(data_dir, archive_dir)
+        self.history_dir = os.path.join(data_dir, history_dir)
+        
+        # Flag per tenere traccia del primo avvio
+        self.primo_avvio = True
+        # Contatore per tracciare le richieste (invio ogni 12 check)
+        self.check_counter = 0
+        # Chiave di rendering del contenuto attuale di ogni file di mappa { percorso: chiave }
+        self.rendered_keys = {}
+        
+        # Connessione al database delle posizioni (aperta al primo utilizzo)
+        self.db_conn = None
+        self.db_lock = threading.RLock()
+        # Buffer circolare delle ultime posizioni in ordine cronologico, condiviso da mappe e conteggi
+        self.recent_positions = deque(maxlen=RECENT_POSITIONS_SIZE)
+        # Numero totale di posizioni nell'archivio, aggiornato a ogni inserimento
+        self.positions_count = 0
+        self.recent_positions_lock = threading.Lock()
+        # Evita due check contemporanei dello stesso veicolo
+        self.poll_lock = threading.Lock()
+        # Evita due aggiornamenti contemporanei dello storico Parquet
+        self.history_lock = threading.Lock()
+        # Viaggi conclusi, posizioni dopo l'ultimo viaggio concluso (sosta e viaggio in corso)
+        # e numero progressivo dell'ultima posizione già segmentata
+        self.trips = deque(maxlen=TRIPS_HISTORY_SIZE)
+        self.trip_tail = None
+        self.trip_seq = 0
+        self.trips_lock = threading.Lock()
+        # Intervallo attuale del polling adattivo e posizione di riferimento per il movimento
+        self.poll_interval = min(max(POLL_INTERVAL_SECONDS, POLL_MIN_INTERVAL_SECONDS), POLL_MAX_INTERVAL_SECONDS)
+        self.motion_reference = None
+        # Istante (epoch) del prossimo invio dei file di riepilogo
+        self.next_files_send = None
+        
+    def route_map_file(self, num_positions):
+        return self.route_map_file_5 if num_positions == 5 else self.route_map_file_20
+        
+    def route_interactive_file(self, num_positions):
+        return os.path.join(self.data_dir, f"route_map_{num_positions}.html")
+        
+    def title(self):
+        """Suffisso con il nome del veicolo per i messaggi (solo in modalità flotta)"""
+        return f" - {self.name}" if FLEET_FILE else ""
 
-def debug_telegram_channel():
+def load_units():
+    """Carica i veicoli da monitorare: la flotta da FLEET_FILE o il veicolo singolo dal .env"""
+    units.clear()
+    if not FLEET_FILE:
+        units[str(unit_id)] = Unit(unit_id, token, auth_token, CHAT_ID)
+        return list(units.values())
+        
+    with open(FLEET_FILE, encoding="utf-8") as f:
+        fleet = json.load(f)
+    for entry in fleet:
+        unit = Unit(
+            entry["unit_id"],
+            entry["targa_token"],
+            entry.get("auth_token", auth_token),
+            entry.get("chat_id", CHAT_ID),
+            name=entry.get("name"),
+            data_dir=os.path.join(FLEET_DATA_DIR, str(entry["unit_id"]))
+        )
+        units[unit.unit_id] = unit
+    print(f"Modalità flotta: caricati {len(units)} veicoli da {FLEET_FILE}")
+    return list(units.values())
+
+class TokenBucket:
+    """Limitatore a token: rate token al secondo, al massimo capacity accumulati"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Prenota un token e restituisce i secondi da attendere prima di usarlo"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Il token viene prenotato subito: chi arriva dopo attende il proprio turno
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds):
+        """Sospende il bucket per il tempo indicato da Telegram (risposta 429)"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+
+class TelegramClient:
+    """Client Telegram condiviso: connessioni persistenti, limiti di invio e coda con retry"""
+
+    def __init__(self, api_url, workers=TELEGRAM_SEND_WORKERS):
+        self.api_url = api_url
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers + 2))
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = {}
+        # Coda degli invii: quelli pronti in ordine di priorità e di arrivo,
+        # quelli in attesa di un token o di un retry in ordine di istante di partenza
+        self.ready = []    # heap di (priorità, progressivo, job)
+        self.delayed = []  # heap di (istante monotonic, progressivo, job)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.workers = workers
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stats = {"sent": 0, "retries": 0, "throttled": 0, "failed": 0}
+        self.stats_lock = threading.Lock()
+
+    def request(self, method, data=None, json=None, files=None, params=None, timeout=TELEGRAM_TIMEOUT):
+        """Singola chiamata all'API, senza coda né limiti (getChat, getUpdates)"""
+        return self.session.post(
+            f"{self.api_url}/{method}",
+            data=data,
+            json=json,
+            files=files,
+            params=params,
+            timeout=timeout
+        )
+
+    def send(self, method, chat_id=None, data=None, json=None, files=None, wait=True):
+        """Accoda un invio; con wait=True attende e restituisce la risposta, altrimenti un Future"""
+        if files:
+            # I file vengono letti subito: il chiamante può chiuderli e i retry li reinviano uguali
+            files = {
+                name: (os.path.basename(getattr(f, "name", name)), f.read())
+                for name, f in files.items()
+            }
+        future = Future()
+        self.start()
+        self.schedule({
+            "method": method,
+            "chat_id": chat_id,
+            "data": data,
+            "json": json,
+            "files": files,
+            "future": future,
+            "priority": 0 if method in TELEGRAM_PRIORITY_METHODS else 1,
+            "attempt": 0,
+            "reserved": set()
+        })
+        return future.result() if wait else future
+
+    def schedule(self, job, delay=0):
+        """Mette un invio in coda, subito o dopo delay secondi"""
+        with self.condition:
+            self.sequence += 1
+            if delay > 0:
+                heapq.heappush(self.delayed, (time.monotonic() + delay, self.sequence, job))
+            else:
+                heapq.heappush(self.ready, (job["priority"], self.sequence, job))
+            self.condition.notify()
+
+    def next_job(self):
+        """Attende il prossimo invio pronto (il più prioritario tra quelli già partibili)"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, sequence, job = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (job["priority"], sequence, job))
+                if self.ready:
+                    return heapq.heappop(self.ready)[2]
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.worker, name=f"telegram-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            try:
+                response = self.deliver(job)
+            except Exception as e:
+                job["future"].set_exception(e)
+                continue
+            if response is not None:
+                job["future"].set_result(response)
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(str(chat_id))
+            if bucket is None:
+                # Gruppi e canali (id negativi): TELEGRAM_CHAT_RATE messaggi al minuto, chat private: uno al secondo
+                per_minute = TELEGRAM_CHAT_RATE if str(chat_id).startswith(("-", "@")) else 60
+                bucket = TokenBucket(per_minute / 60, 3)
+                self.chat_buckets[str(chat_id)] = bucket
+            return bucket
+
+    def deliver(self, job):
+        """Un tentativo di invio: la risposta finale, oppure None se l'invio è stato rimesso in coda
+        (token non ancora disponibile, 429, errore del server o di rete)"""
+        method = job["method"]
+        buckets = [("global", self.global_bucket)]
+        if job["chat_id"] is not None:
+            buckets.insert(0, ("chat", self.chat_bucket(job["chat_id"])))
+        for name, bucket in buckets:
+            if name in job["reserved"]:
+                continue
+            # Il token viene prenotato subito; se non è ancora disponibile l'invio torna in coda
+            # fino a quell'istante, senza tenere occupato un worker (gli invii alle altre chat proseguono)
+            wait = bucket.reserve()
+            job["reserved"].add(name)
+            if wait > 0:
+                self.schedule(job, wait)
+                return None
+        job["reserved"] = set()
+        
+        try:
+            response = self.request(method, data=job["data"], json=job["json"], files=job["files"])
+            error = None
+        except requests.RequestException as e:
+            response = None
+            error = e
+        job["attempt"] += 1
+        
+        if response is not None and response.status_code == 429:
+            retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            print(f"Telegram: limite superato su {method}, nuovo tentativo tra {retry_after}s")
+            self.count("throttled")
+            buckets[0][1].block(retry_after)
+            delay = retry_after
+        elif response is not None and response.status_code < 500:
+            self.count("sent" if response.status_code == 200 else "failed")
+            return response
+        else:
+            # Errore del server o di rete: backoff esponenziale
+            delay = min(2 ** (job["attempt"] - 1), 60)
+            print(f"Telegram: errore su {method} ({error or response.status_code}), nuovo tentativo tra {delay}s")
+            
+        if job["attempt"] >= TELEGRAM_MAX_RETRIES:
+            self.count("failed")
+            if response is None:
+                raise error
+            return response
+        self.count("retries")
+        self.schedule(job, delay)
+        return None
+
+# Client Telegram condiviso da tutti i veicoli
+telegram = TelegramClient(TELEGRAM_API_URL)
+
+def debug_telegram_channel(chat_id=CHAT_ID):
     try:
         # Prova a ottenere informazioni sul canale
-        response = requests.post(
-            f"{TELEGRAM_API_URL}/getChat",
-            json={"chat_id": CHAT_ID}
-        )
+        response = telegram.request("getChat", json={"chat_id": chat_id})
         print("\nDebug informazioni canale:")
         print(f"Status code: {response.status_code}")
         print(f"Risposta API: {response.text}")
@@ -94,18 +713,19 @@ def debug_telegram_channel():
         print(f"Errore nel debug del canale: {e}")
         return False
 
-def test_telegram_connection():
+def test_telegram_connection(chat_id=CHAT_ID):
     try:
         # Prima verifichiamo le informazioni del canale
-        if not debug_telegram_channel():
+        if not debug_telegram_channel(chat_id):
             print("❌ Impossibile ottenere informazioni sul canale")
             return False
 
         # Prova a inviare un messaggio di test
-        response = requests.post(
-            f"{TELEGRAM_API_URL}/sendMessage",
+        response = telegram.send(
+            "sendMessage",
+            chat_id=chat_id,
             json={
-                "chat_id": CHAT_ID,
+                "chat_id": chat_id,
                 "text": "Test di connessione Telegram\nSe ricevi questo messaggio, la connessione funziona correttamente."
             }
         )
@@ -119,225 +739,1169 @@ def test_telegram_connection():
         print(f"❌ Errore nel test di connessione Telegram: {e}")
         return False
 
-def count_available_positions():
-    """Conta quante posizioni sono disponibili nel file CSV"""
+def get_db(unit):
+    """Restituisce la connessione al database delle posizioni del veicolo, creandolo se necessario"""
+    if unit.db_conn is not None:
+        return unit.db_conn
+
+    conn = sqlite3.connect(unit.db_file, check_same_thread=False)
+    # WAL: ogni nuova posizione è una sola append sul log, senza riscrivere l'archivio
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Le colonne senza tipo conservano i valori così come arrivano dall'API
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS positions (
+            timestamp TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            speed, mileage, description, battery, fix, hdop,
+            via, comune, provincia,
+            UNIQUE (lat, lon, timestamp)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_positions_timestamp ON positions (timestamp)")
+    conn.commit()
+    unit.db_conn = conn
+
+    import_csv_into_db(unit)
+    return unit.db_conn
+
+def import_csv_into_db(unit):
+    """Importa lo storico dal vecchio positions_log.csv se il database è ancora vuoto"""
+    conn = unit.db_conn
+    if conn.execute("SELECT 1 FROM positions LIMIT 1").fetchone() is not None:
+        return 0
+    if not os.path.exists(unit.csv_file):
+        return 0
+
+    try:
+        existing_df = pd.read_csv(unit.csv_file)
+        for column in POSITION_COLUMNS:
+            if column not in existing_df.columns:
+                existing_df[column] = None
+        existing_df = existing_df[POSITION_COLUMNS].astype(object)
+        existing_df = existing_df.where(pd.notna(existing_df), None)
+
+        placeholders = ", ".join("?" for _ in POSITION_COLUMNS)
+        conn.executemany(
+            f"INSERT OR IGNORE INTO positions ({', '.join(POSITION_COLUMNS)}) VALUES ({placeholders})",
+            existing_df.itertuples(index=False, name=None)
+        )
+        conn.commit()
+        print(f"Importate {len(existing_df)} posizioni da {unit.csv_file} in {unit.db_file}")
+        return len(existing_df)
+    except Exception as e:
+        print(f"Errore nell'importazione del file CSV esistente: {e}")
+        return 0
+
+def insert_positions(unit, positions):
+    """Aggiunge un blocco di posizioni in un'unica transazione, restituisce quelle nuove"""
+    if not positions:
+        return []
+    conn = get_db(unit)
+    placeholders = ", ".join("?" for _ in POSITION_COLUMNS)
+    inserted = []
+    with unit.db_lock:
+        for position in positions:
+            cursor = conn.execute(
+                f"INSERT OR IGNORE INTO positions ({', '.join(POSITION_COLUMNS)}) VALUES ({placeholders})",
+                [position.get(column) for column in POSITION_COLUMNS]
+            )
+            if cursor.rowcount == 1:
+                inserted.append(position)
+        conn.commit()
+    return inserted
+
+def filter_new_positions(unit, positions):
+    """Scarta le posizioni già presenti nell'archivio con una sola query sull'intervallo del blocco"""
+    if not positions:
+        return []
+    timestamps = [position["timestamp"] for position in positions]
+    with unit.db_lock:
+        rows = get_db(unit).execute(
+            "SELECT lat, lon, timestamp FROM positions WHERE timestamp BETWEEN ? AND ?",
+            (min(timestamps), max(timestamps))
+        ).fetchall()
+    existing = set(rows)
+    return [
+        position for position in positions
+        if (position["lat"], position["lon"], position["timestamp"]) not in existing
+    ]
+
+def positions_range_filter(since_seq=None, until_seq=None):
+    """Condizione SQL sul numero progressivo (rowid) delle posizioni: since_seq < rowid <= until_seq"""
+    conditions = []
+    params = []
+    if since_seq is not None:
+        conditions.append("rowid > ?")
+        params.append(int(since_seq))
+    if until_seq is not None:
+        conditions.append("rowid <= ?")
+        params.append(int(until_seq))
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+def load_positions(unit, limit=None, since_seq=None, until_seq=None):
+    """Carica le posizioni dall'archivio, dalla più recente alla più vecchia"""
+    where, params = positions_range_filter(since_seq, until_seq)
+    query = f"SELECT {', '.join(POSITION_COLUMNS)} FROM positions{where} ORDER BY timestamp DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(int(limit))
+    return pd.read_sql_query(query, get_db(unit), params=params)
+
+def get_last_sequence(unit):
+    """Numero progressivo dell'ultima posizione registrata (l'archivio è solo in aggiunta)"""
+    with unit.db_lock:
+        row = get_db(unit).execute("SELECT MAX(rowid) FROM positions").fetchone()
+    return row[0] or 0
+
+def load_recent_positions(unit, num_positions):
+    """Carica le ultime n posizioni in ordine cronologico (per il percorso)"""
+    positions_df = load_positions(unit, num_positions)
+    return positions_df.iloc[::-1].reset_index(drop=True)
+
+def export_positions_csv(unit, output_file=None, since_seq=None, until_seq=None):
+    """Esporta l'archivio (o le posizioni dell'intervallo indicato) in CSV, più recenti prima"""
+    output_file = output_file or unit.csv_file
+    try:
+        load_positions(unit, since_seq=since_seq, until_seq=until_seq).to_csv(output_file, index=False, encoding="utf-8")
+        print(f"File {output_file} esportato con successo")
+        return True
+    except Exception as e:
+        print(f"Errore nell'esportazione del file CSV: {e}")
+        return False
+
+# Formato di una posizione nel registro testuale
+TXT_RECORD_FORMAT = (
+    "Data/Ora: {timestamp}\n"
+    "Coordinate: {lat}, {lon}\n"
+    "Velocità: {speed} km/h\n"
+    "Chilometraggio: {mileage} km\n"
+    "Via: {via}\n"
+    "Comune: {comune}\n"
+    "Provincia: {provincia}\n"
+    "Batteria: {battery} V\n"
+    "Descrizione: {description}\n"
+    + "-" * 50 + "\n\n"
+)
+
+def export_positions_txt(unit, output_file=None, since_seq=None, until_seq=None):
+    """Esporta l'archivio (o le posizioni dell'intervallo indicato) nel registro testuale, più recenti prima"""
+    output_file = output_file or unit.txt_file
+    where, params = positions_range_filter(since_seq, until_seq)
+    columns = ["timestamp", "lat", "lon", "speed", "mileage", "via", "comune", "provincia", "battery", "description"]
     try:
-        if not os.path.exists(csv_file):
+        # Connessione di sola lettura separata: in WAL la lettura non blocca i nuovi inserimenti
+        get_db(unit)
+        conn = sqlite3.connect(unit.db_file)
+        try:
+            cursor = conn.execute(f"SELECT {', '.join(columns)} FROM positions{where} ORDER BY timestamp DESC", params)
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write("REGISTRO POSIZIONI VEICOLO\n")
+                f.write("=" * 50 + "\n\n")
+                while True:
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+                    f.writelines(TXT_RECORD_FORMAT.format(**dict(zip(columns, row))) for row in rows)
+        finally:
+            conn.close()
+        print(f"File {output_file} esportato con successo")
+        return True
+    except Exception as e:
+        print(f"Errore nell'esportazione del file .txt: {e}")
+        return False
+
+def changed_archive_days(unit, since_seq, until_seq):
+    """Giorni (AAAA-MM-GG) con posizioni aggiunte nell'intervallo di numeri progressivi indicato"""
+    where, params = positions_range_filter(since_seq, until_seq)
+    with unit.db_lock:
+        rows = get_db(unit).execute(
+            f"SELECT DISTINCT substr(timestamp, 1, 10) FROM positions{where}", params
+        ).fetchall()
+    return sorted(row[0] for row in rows)
+
+def export_archive_segment(unit, day):
+    """Esporta le posizioni di un giorno in archive/positions_<giorno>.csv.gz (più recenti prima)"""
+    os.makedirs(unit.archive_dir, exist_ok=True)
+    output_file = os.path.join(unit.archive_dir, f"positions_{day}.csv.gz")
+    temp_file = f"{output_file}.tmp"
+    # Connessione di sola lettura separata, righe lette a blocchi: memoria limitata a un blocco
+    get_db(unit)
+    conn = sqlite3.connect(unit.db_file)
+    try:
+        cursor = conn.execute(
+            f"SELECT {', '.join(POSITION_COLUMNS)} FROM positions WHERE substr(timestamp, 1, 10) = ? ORDER BY timestamp DESC",
+            (day,)
+        )
+        # mtime fisso: lo stesso contenuto produce lo stesso file (e lo stesso file_id su Telegram)
+        with open(temp_file, 'wb') as raw, gzip.GzipFile(filename=os.path.basename(output_file)[:-3], mode='wb', fileobj=raw, mtime=0) as gz:
+            with io.TextIOWrapper(gz, encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(POSITION_COLUMNS)
+                while True:
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+                    writer.writerows(rows)
+        os.replace(temp_file, output_file)
+    finally:
+        conn.close()
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return output_file
+
+def timestamp_to_ms(value):
+    """Converte un timestamp (stringa ISO, datetime o millisecondi epoch) in millisecondi epoch, UTC se senza fuso"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return int(timestamp.value // 1_000_000)
+
+def history_partition_file(unit, day):
+    return os.path.join(unit.history_dir, f"date={day}", "positions.parquet")
+
+def write_history_partition(unit, day):
+    """Riscrive dall'archivio SQLite la partizione Parquet di un giorno"""
+    with unit.db_lock:
+        df = pd.read_sql_query(
+            f"SELECT {', '.join(POSITION_COLUMNS)} FROM positions WHERE substr(timestamp, 1, 10) = ? ORDER BY timestamp",
+            get_db(unit),
+            params=(day,)
+        )
+    timestamps = pd.to_datetime(df["timestamp"], utc=True, errors="coerce", format="mixed")
+    df = df[timestamps.notna()].copy()
+    df["ts"] = (timestamps[timestamps.notna()].astype("int64") // 1_000_000).astype("int64")
+    for column in ("lat", "lon", "speed", "mileage", "battery", "hdop"):
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    for column in ("timestamp", "description", "fix", "via", "comune", "provincia"):
+        df[column] = df[column].map(lambda value: None if value is None else str(value))
+        
+    output_file = history_partition_file(unit, day)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    temp_file = f"{output_file}.tmp"
+    table = pa.Table.from_pandas(df[HISTORY_SCHEMA.names], schema=HISTORY_SCHEMA, preserve_index=False)
+    pq.write_table(table, temp_file)
+    os.replace(temp_file, output_file)
+    return len(df)
+
+def sync_history(unit):
+    """Porta lo storico Parquet in pari con l'archivio, riscrivendo solo i giorni con nuove posizioni"""
+    with unit.history_lock:
+        synced_key = f"history_seq:{unit.unit_id}"
+        synced_seq = get_state_value(synced_key, 0)
+        last_seq = get_last_sequence(unit)
+        if last_seq <= synced_seq:
             return 0
-        positions_df = pd.read_csv(csv_file)
-        return len(positions_df)
+        days = changed_archive_days(unit, synced_seq, last_seq)
+        for day in days:
+            write_history_partition(unit, day)
+        set_state_value(synced_key, last_seq)
+        print(f"[{unit.name}] Storico Parquet aggiornato: {len(days)} giorni")
+        return len(days)
+
+def query_positions(unit, start=None, end=None, columns=None):
+    """Posizioni con start <= ts < end in ordine cronologico, leggendo solo le partizioni e le colonne necessarie"""
+    sync_history(unit)
+    start_ms = timestamp_to_ms(start) if start is not None else None
+    end_ms = timestamp_to_ms(end) if end is not None else None
+    columns = list(columns) if columns else list(HISTORY_SCHEMA.names)
+    read_columns = columns if "ts" in columns else columns + ["ts"]
+    
+    # Le partizioni sono per giorno del timestamp originale: un giorno di margine per i fusi orari
+    day_ms = 24 * 3600 * 1000
+    first_day = datetime.utcfromtimestamp((start_ms - day_ms) / 1000).strftime("%Y-%m-%d") if start_ms is not None else ""
+    last_day = datetime.utcfromtimestamp((end_ms + day_ms) / 1000).strftime("%Y-%m-%d") if end_ms is not None else "9999"
+    filters = []
+    if start_ms is not None:
+        filters.append(("ts", ">=", start_ms))
+    if end_ms is not None:
+        filters.append(("ts", "<", end_ms))
+        
+    tables = []
+    if os.path.isdir(unit.history_dir):
+        for name in sorted(os.listdir(unit.history_dir)):
+            day = name[len("date="):]
+            if not name.startswith("date=") or not first_day <= day <= last_day:
+                continue
+            tables.append(pq.read_table(history_partition_file(unit, day), columns=read_columns, filters=filters or None))
+            
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = pa.concat_tables(tables).to_pandas().sort_values("ts").reset_index(drop=True)
+    return df[columns]
+
+def init_recent_positions(unit):
+    """Riempie il buffer delle posizioni recenti dall'archivio (una sola volta all'avvio)"""
+    try:
+        positions_df = load_recent_positions(unit, RECENT_POSITIONS_SIZE).astype(object)
+        positions_df = positions_df.where(pd.notna(positions_df), None)
+        total = get_db(unit).execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+        with unit.recent_positions_lock:
+            unit.recent_positions.clear()
+            unit.recent_positions.extend(positions_df.to_dict("records"))
+            unit.positions_count = total
+        print(f"[{unit.name}] Caricate {len(unit.recent_positions)} posizioni recenti in memoria ({total} in archivio)")
+        return True
     except Exception as e:
-        print(f"Errore nel conteggio delle posizioni: {e}")
+        print(f"Errore nel caricamento delle posizioni recenti: {e}")
+        return False
+
+def add_recent_position(unit, position):
+    """Aggiunge una nuova posizione al buffer mantenendo l'ordine cronologico"""
+    recent_positions = unit.recent_positions
+    with unit.recent_positions_lock:
+        unit.positions_count += 1
+        if not recent_positions or position["timestamp"] >= recent_positions[-1]["timestamp"]:
+            recent_positions.append(position)
+            return
+        # Posizione arrivata fuori ordine: la inseriamo al suo posto
+        timestamps = [p["timestamp"] for p in recent_positions]
+        index = bisect_right(timestamps, position["timestamp"])
+        if index == 0 and len(recent_positions) == recent_positions.maxlen:
+            return  # Più vecchia di tutto il buffer pieno
+        if len(recent_positions) == recent_positions.maxlen:
+            recent_positions.popleft()
+            index -= 1
+        recent_positions.insert(index, position)
+
+def get_recent_positions(unit, num_positions):
+    """Restituisce le ultime n posizioni in ordine cronologico, senza leggere file"""
+    recent_positions = unit.recent_positions
+    with unit.recent_positions_lock:
+        count = min(num_positions, len(recent_positions))
+        return [recent_positions[i] for i in range(len(recent_positions) - count, len(recent_positions))]
+
+def count_available_positions(unit):
+    """Restituisce quante posizioni sono disponibili nell'archivio"""
+    return unit.positions_count
+
+def create_chrome_driver():
+    """Avvia un'istanza di Chrome headless per il rendering"""
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--window-size=800,600")
+    driver = webdriver.Chrome(options=chrome_options)
+    # Un browser bloccato (non crashato) fallisce entro il tempo di un job invece dei 300s predefiniti
+    # di Selenium: l'eccezione fa riavviare il browser come dopo un crash
+    driver.set_page_load_timeout(RENDER_JOB_TIMEOUT)
+    driver.set_script_timeout(RENDER_JOB_TIMEOUT)
+    return driver
+
+def close_chrome_driver(driver):
+    """Chiude un browser ignorando gli errori (ad esempio se è già crashato)"""
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+def record_render_wait(wait_seconds, timed_out):
+    """Registra il tempo di attesa di un rendering nelle metriche"""
+    with render_metrics_lock:
+        render_metrics["renders"] += 1
+        render_metrics["wait_total"] += wait_seconds
+        render_metrics["wait_last"] = wait_seconds
+        render_metrics["wait_max"] = max(render_metrics["wait_max"], wait_seconds)
+        if timed_out:
+            render_metrics["timeouts"] += 1
+
+def get_render_metrics():
+    """Restituisce una copia delle metriche di rendering con la media delle attese"""
+    with render_metrics_lock:
+        metrics = dict(render_metrics)
+    metrics["wait_avg"] = metrics["wait_total"] / metrics["renders"] if metrics["renders"] else 0.0
+    return metrics
+
+def wait_for_tiles(driver):
+    """Attende che le tile Leaflet siano caricate, al massimo RENDER_TILES_TIMEOUT secondi"""
+    start = time.monotonic()
+    timed_out = False
+    try:
+        WebDriverWait(driver, RENDER_TILES_TIMEOUT, poll_frequency=0.05).until(
+            lambda d: d.execute_script(TILES_READY_SCRIPT)
+        )
+        if RENDER_SETTLE_SECONDS > 0:
+            time.sleep(RENDER_SETTLE_SECONDS)
+    except TimeoutException:
+        timed_out = True
+        
+    wait_seconds = time.monotonic() - start
+    record_render_wait(wait_seconds, timed_out)
+    if timed_out:
+        print(f"Timeout nel caricamento delle tile dopo {wait_seconds:.2f}s, screenshot parziale")
+    else:
+        print(f"Tile caricate in {wait_seconds:.2f}s")
+    return not timed_out
+
+def renderer_worker(worker_id):
+    """Thread del pool: tiene un browser caldo e processa i job dalla coda"""
+    driver = None
+    page_file = os.path.join(tempfile.gettempdir(), f"tracker_render_{os.getpid()}_{worker_id}.html")
+    job_counter = 0
+    
+    while True:
+        job = render_queue.get()
+        if job is None:
+            break
+            
+        try:
+            with open(page_file, 'w', encoding='utf-8') as f:
+                f.write(job["html"])
+                
+            # Un secondo tentativo con un browser nuovo se quello attuale è crashato
+            for attempt in range(2):
+                try:
+                    if driver is None:
+                        print(f"Renderer {worker_id}: avvio browser headless")
+                        driver = create_chrome_driver()
+                    job_counter += 1
+                    driver.get(f"file://{page_file}?job={job_counter}")
+                    
+                    # Aspetta che le tile della mappa siano caricate
+                    wait_for_tiles(driver)
+                    
+                    job["png"] = driver.get_screenshot_as_png()
+                    break
+                except Exception as e:
+                    print(f"Renderer {worker_id}: errore del browser, riavvio ({e})")
+                    close_chrome_driver(driver)
+                    driver = None
+                    if attempt == 1:
+                        job["error"] = e
+        except Exception as e:
+            job["error"] = e
+        finally:
+            job["done"].set()
+            render_queue.task_done()
+            
+    if driver is not None:
+        close_chrome_driver(driver)
+    if os.path.exists(page_file):
+        os.remove(page_file)
+
+def start_renderer_pool():
+    """Avvia i thread del pool di rendering (una sola volta)"""
+    with renderer_lock:
+        if renderer_threads:
+            return
+        for worker_id in range(RENDERER_POOL_SIZE):
+            thread = threading.Thread(target=renderer_worker, args=(worker_id,), daemon=True)
+            thread.start()
+            renderer_threads.append(thread)
+        print(f"Pool di rendering avviato con {RENDERER_POOL_SIZE} browser")
+
+def stop_renderer_pool():
+    """Chiude i browser del pool alla terminazione del programma"""
+    with renderer_lock:
+        for _ in renderer_threads:
+            render_queue.put(None)
+        for thread in renderer_threads:
+            thread.join(timeout=10)
+        renderer_threads.clear()
+
+atexit.register(stop_renderer_pool)
+
+def render_html_to_png(html, output_file):
+    """Invia un job al pool di rendering e salva lo screenshot risultante"""
+    start_renderer_pool()
+    
+    job = {"html": html, "png": None, "error": None, "done": threading.Event()}
+    render_queue.put(job)
+    
+    if not job["done"].wait(RENDER_JOB_TIMEOUT):
+        print(f"Timeout nel rendering di {output_file}")
+        return False
+    if job["error"] is not None:
+        print(f"Errore nel rendering di {output_file}: {job['error']}")
+        return False
+        
+    with open(output_file, 'wb') as f:
+        f.write(job["png"])
+    return True
+
+def get_tile_cache_db():
+    """Restituisce la connessione alla cache delle tile, creandola se necessario"""
+    global tile_cache_conn, tile_cache_size
+    if tile_cache_conn is not None:
+        return tile_cache_conn
+        
+    conn = sqlite3.connect(tile_cache_file, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tiles (
+            style TEXT NOT NULL,
+            z INTEGER NOT NULL,
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL,
+            PRIMARY KEY (style, z, x, y)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tiles_last_access ON tiles (last_access)")
+    conn.commit()
+    tile_cache_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+    tile_cache_conn = conn
+    return tile_cache_conn
+
+def evict_tiles():
+    """Rimuove le tile usate meno di recente finché la cache rientra nel limite di dimensione"""
+    global tile_cache_size
+    conn = get_tile_cache_db()
+    while tile_cache_size > TILE_CACHE_MAX_BYTES:
+        oldest = conn.execute(
+            "SELECT rowid, size FROM tiles ORDER BY last_access LIMIT 100"
+        ).fetchall()
+        if not oldest:
+            tile_cache_size = 0
+            break
+        for rowid, size in oldest:
+            conn.execute("DELETE FROM tiles WHERE rowid = ?", (rowid,))
+            tile_cache_size -= size
+            tile_cache_stats["evictions"] += 1
+            if tile_cache_size <= TILE_CACHE_MAX_BYTES:
+                break
+    conn.commit()
+
+def download_tile(z, x, y, style):
+    """Scarica una tile dal fornitore e restituisce i byte PNG (None se non disponibile)"""
+    url_template = TILE_URLS[style]
+    subdomain = "abcd"[(x + y) % 4]
+    url = url_template.format(s=subdomain, z=z, x=x, y=y)
+    try:
+        response = tile_session.get(url, timeout=10)
+        if response.status_code != 200:
+            print(f"Errore nel download della tile {z}/{x}/{y}: {response.status_code}")
+            return None
+        return response.content
+    except Exception as e:
+        print(f"Errore nel download della tile {z}/{x}/{y}: {e}")
+        return None
+
+def get_tile_bytes(z, x, y, style=MAP_TILES):
+    """Restituisce una tile dalla cache locale, scaricandola solo se manca"""
+    global tile_cache_size
+    key = (style, z, x, y)
+    
+    if TILE_CACHE_MAX_BYTES > 0:
+        with tile_cache_lock:
+            conn = get_tile_cache_db()
+            row = conn.execute(
+                "SELECT data FROM tiles WHERE style = ? AND z = ? AND x = ? AND y = ?", key
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE tiles SET last_access = ? WHERE style = ? AND z = ? AND x = ? AND y = ?",
+                    (time.time(),) + key
+                )
+                conn.commit()
+                tile_cache_stats["hits"] += 1
+                return row[0]
+            tile_cache_stats["misses"] += 1
+    
+    # Download fuori dal lock per non bloccare le altre richieste
+    data = download_tile(z, x, y, style)
+    if data is None:
+        with tile_cache_lock:
+            tile_cache_stats["errors"] += 1
+        return None
+        
+    if TILE_CACHE_MAX_BYTES > 0:
+        with tile_cache_lock:
+            conn = get_tile_cache_db()
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO tiles (style, z, x, y, data, size, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (data, len(data), time.time())
+            )
+            conn.commit()
+            if cursor.rowcount == 1:
+                tile_cache_size += len(data)
+                if tile_cache_size > TILE_CACHE_MAX_BYTES:
+                    evict_tiles()
+    return data
+
+def get_tile_cache_stats():
+    """Restituisce i contatori della cache delle tile (hit, miss, evizioni, errori, dimensione)"""
+    with tile_cache_lock:
+        stats = dict(tile_cache_stats)
+        stats["size_bytes"] = tile_cache_size
+    return stats
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Serve le tile della cache al browser di rendering: /tiles/<stile>/<z>/<x>/<y>.png"""
+    
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        try:
+            if len(parts) != 5 or parts[0] != "tiles" or not parts[4].endswith(".png"):
+                raise ValueError(self.path)
+            style = unquote(parts[1])
+            z, x, y = int(parts[2]), int(parts[3]), int(parts[4][:-4])
+            if style not in TILE_URLS:
+                raise ValueError(style)
+        except ValueError:
+            self.send_error(404)
+            return
+            
+        data = get_tile_bytes(z, x, y, style)
+        if data is None:
+            self.send_error(502)
+            return
+            
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "max-age=86400")
+        self.end_headers()
+        self.wfile.write(data)
+        
+    def log_message(self, format, *args):
+        pass  # Niente log per ogni tile servita
+
+def start_tile_server():
+    """Avvia (una sola volta) il server locale che serve le tile della cache al browser"""
+    global tile_server
+    with tile_cache_lock:
+        if tile_server is None:
+            tile_server = ThreadingHTTPServer(("127.0.0.1", TILE_SERVER_PORT), TileRequestHandler)
+            tile_server.daemon_threads = True
+            threading.Thread(target=tile_server.serve_forever, daemon=True).start()
+            print(f"Server locale delle tile avviato su 127.0.0.1:{tile_server.server_address[1]}")
+    return f"http://127.0.0.1:{tile_server.server_address[1]}"
+
+def new_map_spec(center, zoom):
+    """Descrizione di una mappa indipendente dal backend di rendering (layer disegnati in ordine)"""
+    return {
+        "center": [center[0], center[1]],
+        "zoom": zoom,
+        "size": list(MAP_IMAGE_SIZE),
+        "tiles": MAP_TILES,
+        "layers": []
+    }
+
+def build_folium_map(spec, tiles_url=None):
+    """Costruisce la mappa folium (interattiva) a partire dalla descrizione"""
+    if tiles_url:
+        # Tile servite da un endpoint alternativo (la cache locale per il browser di rendering)
+        m = folium.Map(location=spec["center"], zoom_start=spec["zoom"], tiles=tiles_url, attr=TILE_ATTRIBUTION)
+    else:
+        m = folium.Map(location=spec["center"], zoom_start=spec["zoom"], tiles=spec["tiles"])
+    
+    for layer in spec["layers"]:
+        if layer["type"] == "circle_marker":
+            folium.CircleMarker(
+                layer["location"],
+                radius=layer["radius"],
+                color=layer["color"],
+                fill=True,
+                fill_color=layer["color"],
+                fill_opacity=layer["fill_opacity"],
+                popup=layer.get("popup")
+            ).add_to(m)
+        elif layer["type"] == "circle":
+            folium.Circle(
+                layer["location"],
+                radius=layer["radius_m"],
+                color=layer["color"],
+                fill=True,
+                fill_opacity=layer["fill_opacity"]
+            ).add_to(m)
+        elif layer["type"] == "label":
+            folium.map.Marker(
+                layer["location"],
+                icon=folium.DivIcon(
+                    icon_size=(60, 20),
+                    icon_anchor=(30, -10),  # Spostato più in basso (-10 invece di 0)
+                    html=f'<div style="font-size: 10pt; color: black; background-color: white; border: 1px solid black; border-radius: 3px; padding: 1px 3px; text-align: center;">{layer["text"]}</div>'
+                )
+            ).add_to(m)
+        elif layer["type"] == "polyline":
+            folium.PolyLine(
+                layer["locations"],
+                color=layer["color"],
+                weight=layer["weight"],
+                opacity=layer["opacity"]
+            ).add_to(m)
+            
+    return m
+
+def encode_polyline(locations, precision=5):
+    """Codifica le coordinate come polyline (delta tra punti consecutivi, caratteri ASCII)"""
+    factor = 10 ** precision
+    result = []
+    previous_lat = previous_lon = 0
+    for lat, lon in locations:
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat - previous_lat, lon - previous_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                result.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            result.append(chr(value + 63))
+        previous_lat, previous_lon = lat, lon
+    return "".join(result)
+
+def build_compact_map_html(spec):
+    """Mappa interattiva compatta: i layer dello stesso tipo e stile diventano un solo gruppo (nell'ordine
+    della loro prima comparsa) con le coordinate codificate una volta sola; marker, popup ed etichette
+    sono creati dal browser"""
+    groups = []
+    groups_by_style = {}
+    for layer in spec["layers"]:
+        if layer["type"] == "polyline":
+            groups.append({"k": "p", "s": [layer["color"], layer["weight"], layer["opacity"]], "l": layer["locations"]})
+            continue
+        if layer["type"] == "circle_marker":
+            kind, style = "m", [layer["radius"], layer["color"], layer["fill_opacity"]]
+        elif layer["type"] == "circle":
+            kind, style = "c", [layer["color"], layer["fill_opacity"]]
+        else:
+            kind, style = "x", []
+        key = json.dumps([kind, style])
+        if key not in groups_by_style:
+            groups_by_style[key] = {"k": kind, "s": style, "l": [], "h": [], "r": [], "x": []}
+            groups.append(groups_by_style[key])
+        group = groups_by_style[key]
+        group["l"].append(layer["location"])
+        group["h"].append(layer.get("popup") or "")
+        group["r"].append(layer.get("radius_m"))
+        group["x"].append(layer.get("text", ""))
+        
+    # Solo i campi usati da ciascun tipo di gruppo, coordinate codificate
+    packed = []
+    for group in groups:
+        item = {"k": group["k"], "s": group["s"], "p": encode_polyline(group["l"])}
+        if group["k"] == "m" and any(group["h"]):
+            item["h"] = group["h"]
+        elif group["k"] == "c":
+            item["r"] = group["r"]
+        elif group["k"] == "x":
+            item["x"] = group["x"]
+        packed.append(item)
+        
+    data = {
+        "c": spec["center"],
+        "z": spec["zoom"],
+        "t": TILE_URLS.get(spec["tiles"], "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"),
+        "a": TILE_ATTRIBUTION,
+        "g": packed
+    }
+    # "</" non deve chiudere lo script che contiene i dati
+    data_json = json.dumps(data, ensure_ascii=False, separators=(",", ":")).replace("</", "<\\/")
+    return COMPACT_MAP_TEMPLATE.replace("__LEAFLET__", LEAFLET_VERSION).replace("__DATA__", data_json)
+
+def save_interactive_map(spec, output_file):
+    """Salva la mappa interattiva nel formato scelto con INTERACTIVE_MAP_MODE"""
+    if INTERACTIVE_MAP_MODE == "compact":
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(build_compact_map_html(spec))
+    else:
+        build_folium_map(spec).save(output_file)
+
+def render_map_image(spec, output_file, backend=None):
+    """Renderizza l'immagine della mappa con il backend richiesto ("browser" o "static")"""
+    backend = backend or MAP_RENDER_BACKEND
+    if backend == "static":
+        return render_static_map(spec, output_file)
+    if backend != "browser":
+        print(f"Backend di rendering sconosciuto '{backend}', uso il browser")
+        
+    # Il browser carica le tile dalla cache locale invece che dalla rete
+    tiles_url = None
+    if TILE_CACHE_MAX_BYTES > 0 and spec["tiles"] in TILE_URLS:
+        tiles_url = f"{start_tile_server()}/tiles/{quote(spec['tiles'])}/{{z}}/{{x}}/{{y}}.png"
+        
+    # Renderizza l'immagine con uno dei browser già avviati del pool
+    return render_html_to_png(build_folium_map(spec, tiles_url).get_root().render(), output_file)
+
+def render_cache_key(spec, kind, backend=None):
+    """Hash dell'input esatto del rendering: tipo di mappa, backend, formato HTML e descrizione (posizioni, stile, dimensioni)"""
+    payload = json.dumps(
+        {"kind": kind, "backend": backend or MAP_RENDER_BACKEND, "html": INTERACTIVE_MAP_MODE, "spec": spec},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def prune_render_cache():
+    """Rimuove i rendering usati meno di recente oltre RENDER_CACHE_MAX_FILES"""
+    try:
+        entries = [os.path.join(RENDER_CACHE_DIR, name) for name in os.listdir(RENDER_CACHE_DIR)]
+    except FileNotFoundError:
+        return
+    entries.sort(key=os.path.getmtime)
+    for path in entries[:max(len(entries) - RENDER_CACHE_MAX_FILES, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def publish_rendered_file(source, target):
+    """Copia un rendering sul file di uscita in modo atomico: chi legge (invii, pulsanti)
+    vede sempre la mappa precedente o quella nuova, mai un file scritto a metà"""
+    temp_file = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        shutil.copyfile(source, temp_file)
+        os.replace(temp_file, target)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def render_map_cached(unit, spec, kind, output_file, interactive_file, backend=None):
+    """Produce immagine e mappa interattiva riutilizzando il rendering se l'input non è cambiato"""
+    key = render_cache_key(spec, kind, backend)
+    if (unit.rendered_keys.get(output_file) == key and unit.rendered_keys.get(interactive_file) == key
+            and os.path.exists(output_file) and os.path.exists(interactive_file)):
+        print(f"Mappa invariata, riutilizzo {output_file}")
+        return True
+        
+    cached_png = os.path.join(RENDER_CACHE_DIR, f"{key}.png")
+    cached_html = os.path.join(RENDER_CACHE_DIR, f"{key}.html")
+    with render_cache_lock:
+        hit = os.path.exists(cached_png) and os.path.exists(cached_html)
+        if hit:
+            # Aggiorna la data di utilizzo per l'evizione LRU
+            os.utime(cached_png)
+            os.utime(cached_html)
+            
+    if hit:
+        print(f"Rendering trovato in cache ({key[:12]})")
+    else:
+        os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+        temp_png = f"{cached_png}.{uuid.uuid4().hex}.tmp"
+        temp_html = f"{cached_html}.{uuid.uuid4().hex}.tmp"
+        try:
+            save_interactive_map(spec, temp_html)
+            if not render_map_image(spec, temp_png, backend):
+                return False
+            # Il rendering entra in cache solo se completo
+            os.replace(temp_html, cached_html)
+            os.replace(temp_png, cached_png)
+        finally:
+            for path in (temp_png, temp_html):
+                if os.path.exists(path):
+                    os.remove(path)
+        with render_cache_lock:
+            prune_render_cache()
+            
+    # Sotto il lock la cache non può essere potata durante la copia
+    with render_cache_lock:
+        publish_rendered_file(cached_html, interactive_file)
+        publish_rendered_file(cached_png, output_file)
+    unit.rendered_keys[output_file] = key
+    unit.rendered_keys[interactive_file] = key
+    return True
+
+def project_to_pixels(lat, lon, zoom):
+    """Proiezione Web Mercator: coordinate -> pixel globali al livello di zoom"""
+    scale = TILE_SIZE * (2 ** zoom)
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0 * scale
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+def meters_per_pixel(lat, zoom):
+    """Metri rappresentati da un pixel alla latitudine e allo zoom indicati"""
+    return 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+def fetch_tile(z, x, y, style=MAP_TILES):
+    """Restituisce una tile della mappa come immagine (None se non disponibile)"""
+    data = get_tile_bytes(z, x, y, style)
+    if data is None:
+        return None
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+def load_label_font():
+    """Carica il font per le etichette, con ripiego sul font integrato di Pillow"""
+    global label_font
+    if label_font is None:
+        try:
+            label_font = ImageFont.truetype("DejaVuSans.ttf", 12)
+        except OSError:
+            label_font = ImageFont.load_default()
+    return label_font
+
+def render_static_map(spec, output_file):
+    """Disegna la mappa direttamente con Pillow: tile affiancate, percorso, marker ed etichette"""
+    try:
+        start = time.monotonic()
+        width, height = spec["size"]
+        zoom = spec["zoom"]
+        center_x, center_y = project_to_pixels(spec["center"][0], spec["center"][1], zoom)
+        left = center_x - width / 2
+        top = center_y - height / 2
+        
+        # Tile necessarie a coprire l'immagine, scaricate in parallelo
+        num_tiles = 2 ** zoom
+        tile_coords = [
+            (tile_x, tile_y)
+            for tile_x in range(math.floor(left / TILE_SIZE), math.floor((left + width - 1) / TILE_SIZE) + 1)
+            for tile_y in range(math.floor(top / TILE_SIZE), math.floor((top + height - 1) / TILE_SIZE) + 1)
+            if 0 <= tile_y < num_tiles
+        ]
+        tiles = tile_executor.map(
+            lambda coords: fetch_tile(zoom, coords[0] % num_tiles, coords[1], spec["tiles"]),
+            tile_coords
+        )
+        
+        image = Image.new("RGB", (width, height), (242, 239, 233))
+        for (tile_x, tile_y), tile in zip(tile_coords, tiles):
+            if tile is not None:
+                image.paste(tile, (round(tile_x * TILE_SIZE - left), round(tile_y * TILE_SIZE - top)))
+        
+        def to_image(location):
+            x, y = project_to_pixels(location[0], location[1], zoom)
+            return x - left, y - top
+        
+        def with_alpha(color, opacity):
+            return ImageColor.getrgb(color) + (round(opacity * 255),)
+        
+        # Draw in modalità RGBA fonde i colori semitrasparenti con lo sfondo
+        draw = ImageDraw.Draw(image, "RGBA")
+        font = load_label_font()
+        
+        for layer in spec["layers"]:
+            if layer["type"] == "circle_marker" or layer["type"] == "circle":
+                x, y = to_image(layer["location"])
+                if layer["type"] == "circle":
+                    radius = layer["radius_m"] / meters_per_pixel(layer["location"][0], zoom)
+                else:
+                    radius = layer["radius"]
+                # Stessi stili predefiniti di Leaflet: bordo pieno spesso 3 pixel
+                draw.ellipse(
+                    (x - radius, y - radius, x + radius, y + radius),
+                    fill=with_alpha(layer["color"], layer["fill_opacity"]),
+                    outline=with_alpha(layer["color"], 1.0),
+                    width=3
+                )
+            elif layer["type"] == "polyline":
+                points = [to_image(location) for location in layer["locations"]]
+                draw.line(points, fill=with_alpha(layer["color"], layer["opacity"]), width=layer["weight"], joint="curve")
+            elif layer["type"] == "label":
+                x, y = to_image(layer["location"])
+                # Stessa geometria della DivIcon folium: 60x20 pixel, 10 pixel sotto il punto
+                box = (x - 30, y + 10, x + 30, y + 30)
+                draw.rounded_rectangle(box, radius=3, fill=(255, 255, 255, 255), outline=(0, 0, 0, 255), width=1)
+                draw.text((x, y + 20), layer["text"], fill=(0, 0, 0, 255), font=font, anchor="mm")
+        
+        # Attribuzione richiesta dai fornitori delle tile
+        draw.text((width - 4, height - 4), TILE_ATTRIBUTION, fill=(80, 80, 80, 255), font=font, anchor="rd")
+        
+        image.save(output_file, "PNG")
+        print(f"Rendering statico completato in {(time.monotonic() - start) * 1000:.0f} ms")
+        return True
+    except Exception as e:
+        print(f"Errore nel rendering statico della mappa: {e}")
+        return False
+
+def fit_zoom(lats, lons, size=MAP_IMAGE_SIZE, padding=40, max_zoom=18):
+    """Zoom più alto a cui tutte le coordinate entrano nell'immagine (con un margine in pixel)"""
+    for zoom in range(max_zoom, 1, -1):
+        x1, y1 = project_to_pixels(max(lats), min(lons), zoom)
+        x2, y2 = project_to_pixels(min(lats), max(lons), zoom)
+        if x2 - x1 <= size[0] - 2 * padding and y2 - y1 <= size[1] - 2 * padding:
+            return zoom
+    return 2
+
+def project_array(lats, lons, zoom):
+    """Proiezione Web Mercator vettoriale: array di coordinate -> pixel globali (n x 2)"""
+    scale = TILE_SIZE * (2 ** zoom)
+    sin_lat = np.sin(np.radians(np.clip(lats, -85.05112878, 85.05112878)))
+    x = (np.asarray(lons) + 180.0) / 360.0 * scale
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * scale
+    return np.column_stack((x, y))
+
+def simplify_route(points, tolerance):
+    """Douglas-Peucker sui punti in pixel: indici dei punti da tenere (sempre il primo e l'ultimo)"""
+    count = len(points)
+    if count < 3:
+        return np.arange(count)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = points[start], points[end]
+        inner = points[start + 1:end]
+        length = math.hypot(*(b - a))
+        if length == 0:
+            distance = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+        else:
+            distance = np.abs((b[0] - a[0]) * (inner[:, 1] - a[1]) - (b[1] - a[1]) * (inner[:, 0] - a[0])) / length
+        index = int(np.argmax(distance))
+        if distance[index] > tolerance:
+            index += start + 1
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    return np.flatnonzero(keep)
+
+def thin_markers(points, spacing, limit):
+    """Al massimo un marker per cella di spacing pixel (e non più di limit), sempre il primo e l'ultimo"""
+    cells = np.floor(points / spacing).astype(np.int64)
+    _, first = np.unique(cells, axis=0, return_index=True)
+    indices = np.union1d(np.sort(first), [0, len(points) - 1])
+    if len(indices) > limit:
+        indices = indices[np.linspace(0, len(indices) - 1, limit).round().astype(np.int64)]
+    return indices
+
+def build_route_spec(positions, label_all=False):
+    """Descrizione della mappa di un percorso con livello di dettaglio adatto allo zoom:
+    tracciato semplificato e marker diradati, così dimensione e tempo di rendering restano limitati"""
+    lats = np.array([float(position['lat']) for position in positions])
+    lons = np.array([float(position['lon']) for position in positions])
+    
+    # Mappa centrata sul percorso, allo zoom più alto che lo contiene tutto
+    zoom_level = fit_zoom(lats, lons)
+    center = [(lats.min() + lats.max()) / 2, (lons.min() + lons.max()) / 2]
+    spec = new_map_spec(center, zoom_level)
+    points = project_array(lats, lons, zoom_level)
+    
+    # Marker (con popup ed etichette) solo dove c'è spazio sulla mappa
+    markers = thin_markers(points, ROUTE_MARKER_SPACING_PX, ROUTE_MAX_MARKERS)
+    for order, index in enumerate(markers):
+        position = positions[index]
+        timestamp = str(position['timestamp'])
+        via = position.get('via') or ''
+        comune = position.get('comune') or ''
+        
+        # Formatta il timestamp per ottenere solo l'orario (HH:MM:SS)
+        try:
+            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+            formatted_time = dt.strftime('%H:%M:%S')
+            formatted_full_time = dt.strftime('%d/%m/%Y %H:%M:%S')
+        except:
+            formatted_time = "??:??:??"
+            formatted_full_time = timestamp
+            
+        # Popup con informazioni
+        popup_text = f"Ora: {formatted_full_time}<br>Velocità: {position.get('speed')} km/h<br>Via: {via}, {comune}"
+        spec["layers"].append({
+            "type": "circle_marker", "location": [float(lats[index]), float(lons[index])],
+            "radius": 6, "color": "red", "fill_opacity": 0.7, "popup": popup_text
+        })
+        
+        # Etichette orarie: tutte sulle mappe brevi, altrimenti ogni 5 marker più la prima e l'ultima
+        if label_all or order % 5 == 0 or order == len(markers) - 1:
+            spec["layers"].append({"type": "label", "location": [float(lats[index]), float(lons[index])], "text": formatted_time})
+            
+    # Tracciato semplificato alla risoluzione dello zoom (tolleranza aumentata se i punti sono ancora troppi)
+    tolerance = ROUTE_SIMPLIFY_TOLERANCE_PX
+    route = simplify_route(points, tolerance)
+    while len(route) > ROUTE_MAX_POINTS:
+        tolerance *= 2
+        route = simplify_route(points, tolerance)
+    if len(route) > 1:
+        spec["layers"].append({
+            "type": "polyline", "locations": [[float(lats[i]), float(lons[i])] for i in route],
+            "color": "blue", "weight": 3, "opacity": 0.8
+        })
+        
+    # Evidenzia l'ultima posizione in modo speciale
+    spec["layers"].append({
+        "type": "circle_marker", "location": [float(lats[-1]), float(lons[-1])],
+        "radius": 10, "color": "green", "fill_opacity": 0.9, "popup": "Ultima posizione"
+    })
+    return spec
+
+def generate_window_map(unit, start, end, output_file, interactive_file, backend=None):
+    """Mappa del percorso in una finestra di tempo qualsiasi (ore o giorni), letta dallo storico colonnare"""
+    try:
+        print(f"Generazione mappa del percorso dal {start} al {end}...")
+        df = query_positions(unit, start, end, ["timestamp", "lat", "lon", "speed", "via", "comune"])
+        if len(df) < 2:
+            print("Non ci sono abbastanza posizioni nella finestra per generare un percorso")
+            return 0
+        spec = build_route_spec(df.to_dict("records"))
+        if not render_map_cached(unit, spec, "route_window", output_file, interactive_file, backend):
+            return 0
+        print(f"Mappa del percorso ({len(df)} posizioni) salvata come {output_file} e {interactive_file}")
+        return len(df)
+    except Exception as e:
+        print(f"Errore nella generazione della mappa del percorso: {e}")
         return 0
 
-def generate_route_map(num_positions, output_file=None, interactive_file=None):
+def generate_route_map(unit, num_positions, output_file=None, interactive_file=None, backend=None):
     """Genera una mappa con l'itinerario delle ultime posizioni"""
     if output_file is None:
-        output_file = route_map_file_5 if num_positions == 5 else route_map_file_20
+        output_file = unit.route_map_file(num_positions)
         
     if interactive_file is None:
-        interactive_file = f"route_map_{num_positions}.html"
+        interactive_file = unit.route_interactive_file(num_positions)
         
     try:
         print(f"Generazione mappa del percorso con ultime {num_positions} posizioni...")
         
-        # Carica i dati delle posizioni
-        try:
-            positions_df = pd.read_csv(csv_file)
-            # Ordina per timestamp in ordine decrescente
-            positions_df = positions_df.sort_values(by='timestamp', ascending=False)
-            # Prendi solo le ultime n posizioni
-            positions_df = positions_df.head(num_positions)
-            # Riordina per timestamp in ordine crescente per il percorso
-            positions_df = positions_df.sort_values(by='timestamp', ascending=True)
-        except Exception as e:
-            print(f"Errore nel caricamento delle posizioni: {e}")
-            return False
+        # Ultime n posizioni in ordine cronologico per il percorso (dal buffer in memoria)
+        positions = get_recent_positions(unit, num_positions)
             
-        if len(positions_df) < 2:
+        if len(positions) < 2:
             print("Non ci sono abbastanza posizioni per generare un percorso")
             return False
         
-        # Estrai le coordinate per calcolare il migliore zoom
-        lats = positions_df['lat'].tolist()
-        lons = positions_df['lon'].tolist()
-        
-        # Calcola il centro della mappa
-        center_lat = sum(lats) / len(lats)
-        center_lon = sum(lons) / len(lons)
-        
-        # Calcola la distanza massima tra i punti per determinare lo zoom appropriato
-        max_lat_diff = max(lats) - min(lats)
-        max_lon_diff = max(lons) - min(lons)
-        
-        # Determina lo zoom in base alla distanza massima
-        # Più piccolo è il valore, più ampio è lo zoom
-        # Converti la differenza in gradi a una stima di zoom
-        zoom_level = 18  # Zoom massimo di default
-        if max_lat_diff > 0.05 or max_lon_diff > 0.05:
-            zoom_level = 12
-        elif max_lat_diff > 0.01 or max_lon_diff > 0.01:
-            zoom_level = 14
-        elif max_lat_diff > 0.005 or max_lon_diff > 0.005:
-            zoom_level = 15
-        elif max_lat_diff > 0.001 or max_lon_diff > 0.001:
-            zoom_level = 16
-        
-        # Crea una mappa centrata sulla posizione media con zoom adattivo
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=zoom_level, tiles='CartoDB positron')
-        
-        # Crea una lista di punti per il percorso
-        route_points = []
-        
-        # Aggiungi marker per ogni posizione
-        for index, position in enumerate(positions_df.iterrows()):
-            position_idx, position = position  # Decompose the tuple
-            lat = position['lat']
-            lon = position['lon']
-            timestamp = position['timestamp']
-            speed = position['speed']
-            via = position['via'] if pd.notna(position['via']) else ''
-            comune = position['comune'] if pd.notna(position['comune']) else ''
-            
-            # Formatta il timestamp per ottenere solo l'orario (HH:MM:SS)
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                formatted_time = dt.strftime('%H:%M:%S')
-                formatted_full_time = dt.strftime('%d/%m/%Y %H:%M:%S')
-            except:
-                formatted_time = "??:??:??"
-                formatted_full_time = timestamp
-                
-            # Popup con informazioni
-            popup_text = f"Ora: {formatted_full_time}<br>Velocità: {speed} km/h<br>Via: {via}, {comune}"
-            
-            # Aggiungi il punto alla lista dei punti del percorso
-            route_points.append([lat, lon])
-            
-            # Aggiungi il marker
-            folium.CircleMarker(
-                [lat, lon], 
-                radius=6,
-                color='red',
-                fill=True,
-                fill_color='red',
-                fill_opacity=0.7,
-                popup=popup_text
-            ).add_to(m)
-            
-            # Determina se dobbiamo mostrare l'etichetta di orario per questa posizione
-            # Per la mappa di 5 posizioni: mostra tutte le etichette
-            # Per la mappa di 20 posizioni: mostra solo ogni 5 posizioni e la prima/ultima
-            show_label = (num_positions <= 5) or (index % 5 == 0) or (index == len(positions_df) - 1) or index == 0
-            
-            if show_label:
-                # Aggiungi label con l'orario
-                folium.map.Marker(
-                    [lat, lon],
-                    icon=folium.DivIcon(
-                        icon_size=(60, 20),
-                        icon_anchor=(30, -10),  # Spostato più in basso (-10 invece di 0)
-                        html=f'<div style="font-size: 10pt; color: black; background-color: white; border: 1px solid black; border-radius: 3px; padding: 1px 3px; text-align: center;">{formatted_time}</div>'
-                    )
-                ).add_to(m)
-        
-        # Aggiungi la linea del percorso
-        if len(route_points) > 1:
-            folium.PolyLine(
-                route_points,
-                color='blue',
-                weight=3,
-                opacity=0.8
-            ).add_to(m)
+        spec = build_route_spec(positions, label_all=num_positions <= 5)
         
-        # Evidenzia l'ultima posizione in modo speciale
-        last_pos = positions_df.iloc[-1]
-        folium.CircleMarker(
-            [last_pos['lat'], last_pos['lon']], 
-            radius=10,
-            color='green',
-            fill=True,
-            fill_color='green',
-            fill_opacity=0.9,
-            popup="Ultima posizione"
-        ).add_to(m)
-        
-        # Salva la versione interattiva
-        m.save(interactive_file)
-        print(f"Mappa interattiva del percorso salvata come {interactive_file}")
-        
-        # Salva la mappa come HTML temporaneo per il rendering dell'immagine
-        map_html = f"temp_route_map_{int(time.time())}.html"
-        m.save(map_html)
-        
-        # Configura Chrome in modalità headless per il rendering
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--window-size=800,600")
-        
-        # Crea un driver browser
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.get(f"file://{os.path.abspath(map_html)}")
-        
-        # Aspetta che la mappa sia caricata completamente
-        time.sleep(2)
-        
-        # Cattura lo screenshot
-        driver.save_screenshot(output_file)
-        
-        # Chiudi il browser e rimuovi il file temporaneo
-        driver.quit()
-        os.remove(map_html)
+        # Versione interattiva e immagine, rigenerate solo se le posizioni del percorso sono cambiate
+        if not render_map_cached(unit, spec, "route", output_file, interactive_file, backend):
+            return False
         
-        print(f"Mappa del percorso salvata come {output_file}")
+        print(f"Mappa del percorso salvata come {output_file} e {interactive_file}")
         return True
     except Exception as e:
         print(f"Errore nella generazione della mappa del percorso: {e}")
         return False
 
-def generate_route_maps_if_needed():
+def generate_route_maps_if_needed(unit):
     """Genera preventivamente le mappe del percorso se ci sono abbastanza posizioni"""
-    global last_route_map_generation
+    # Il rendering avviene solo se le posizioni della finestra sono cambiate (cache dei rendering)
     
-    # Verifica se è passato abbastanza tempo dall'ultima generazione (almeno 10 minuti)
-    current_time = time.time()
-    if current_time - last_route_map_generation < 600:  # 600 secondi = 10 minuti
-        print("Mappe di percorso generate di recente, skippo la rigenerazione")
-        return
-        
     # Conta quante posizioni sono disponibili
-    num_positions = count_available_positions()
+    num_positions = count_available_positions(unit)
     
     # Genera la mappa per 5 posizioni se disponibili
     if num_positions >= 5:
         print("Generazione preventiva della mappa per le ultime 5 posizioni")
-        generate_route_map(5, route_map_file_5)
+        generate_route_map(unit, 5, unit.route_map_file_5)
         
     # Genera la mappa per 20 posizioni se disponibili
     if num_positions >= 20:
         print("Generazione preventiva della mappa per le ultime 20 posizioni")
-        generate_route_map(20, route_map_file_20)
-        
-    # Aggiorna il timestamp dell'ultima generazione
-    last_route_map_generation = current_time
+        generate_route_map(unit, 20, unit.route_map_file_20)
 
-def send_route_map(num_positions):
+def save_message_buttons(response_data, buttons_info):
+    """Salva i pulsanti di un messaggio inviato, indicizzati per (chat, messaggio)"""
+    if not buttons_info or not response_data.get("ok", False) or "result" not in response_data:
+        return
+    result = response_data["result"]
+    message_id = result.get("message_id")
+    chat_id = result.get("chat", {}).get("id")
+    if message_id is not None:
+        message_buttons[(chat_id, message_id)] = buttons_info
+        print(f"Salvati pulsanti per il messaggio {message_id}: {buttons_info}")
+
+def send_route_map(unit, num_positions):
     """Invia una mappa con l'itinerario delle ultime posizioni"""
     try:
         # Determina quale file usare
-        route_file = route_map_file_5 if num_positions == 5 else route_map_file_20
-        interactive_file = f"route_map_{num_positions}.html"
+        route_file = unit.route_map_file(num_positions)
+        interactive_file = unit.route_interactive_file(num_positions)
         
-        # Se il file non esiste o è vecchio, generalo
-        if not os.path.exists(route_file) or (time.time() - os.path.getmtime(route_file)) > 3600:  # 1 ora
-            if not generate_route_map(num_positions, route_file, interactive_file):
-                print(f"Impossibile generare la mappa del percorso per le ultime {num_positions} posizioni")
-                return False
+        # Aggiorna la mappa se le ultime posizioni sono cambiate (altrimenti riusa il rendering in cache)
+        if not generate_route_map(unit, num_positions, route_file, interactive_file):
+            print(f"Impossibile generare la mappa del percorso per le ultime {num_positions} posizioni")
+            return False
                 
         # Formatta il messaggio
-        message = f"```\nROUTE MAP - LAST {num_positions} POSITIONS\n\n"
+        message = f"```\nROUTE MAP - LAST {num_positions} POSITIONS{unit.title()}\n\n"
         message += f"Generated: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n```"
         
         # Aggiungi pulsante per la mappa HTML
@@ -350,7 +1914,8 @@ def send_route_map(num_positions):
             html_map_callbacks[html_callback] = {
                 "file": interactive_file,
                 "type": "route",
-                "num_positions": num_positions
+                "num_positions": num_positions,
+                "unit_id": unit.unit_id
             }
             buttons.append({
                 "text": "🌐 Mappa HTML",
@@ -368,38 +1933,28 @@ def send_route_map(num_positions):
             })
         
         # Invia foto con didascalia
-        message_id = None
-        with open(route_file, 'rb') as photo:
-            files = {'photo': photo}
-            data = {
-                'chat_id': CHAT_ID,
-                'caption': message,
-                'parse_mode': 'Markdown'
-            }
-            
-            # Aggiungi pulsanti solo se disponibili
-            if inline_keyboard:
-                data['reply_markup'] = inline_keyboard
-                
-            response = requests.post(
-                f"{TELEGRAM_API_URL}/sendPhoto",
-                data=data,
-                files=files
-            )
+        response_data = {}
+        data = {
+            'chat_id': unit.chat_id,
+            'caption': message,
+            'parse_mode': 'Markdown'
+        }
+        
+        # Aggiungi pulsanti solo se disponibili
+        if inline_keyboard:
+            data['reply_markup'] = inline_keyboard
             
-            # Estrai il message_id dalla risposta
-            if response.status_code == 200:
-                response_data = response.json()
-                if response_data.get("ok", False) and "result" in response_data:
-                    message_id = response_data["result"].get("message_id")
+        # Una mappa invariata viene reinviata dal file_id, senza ricaricarla
+        response = send_media("sendPhoto", "photo", route_file, unit.chat_id, data)
+        
+        if response.status_code == 200:
+            response_data = response.json()
                 
         if response.status_code == 200:
             print(f"Mappa del percorso per le ultime {num_positions} posizioni inviata con successo")
             
-            # Se abbiamo il message_id e ci sono pulsanti, salva le informazioni
-            if message_id is not None and buttons_info:
-                message_buttons[message_id] = buttons_info
-                print(f"Salvati pulsanti per il messaggio {message_id}: {buttons_info}")
+            # Se ci sono pulsanti, salva le informazioni del messaggio
+            save_message_buttons(response_data, buttons_info)
                 
             return True
         else:
@@ -413,6 +1968,13 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
     """Processa i callback query dai pulsanti inline"""
     global processing_callbacks, message_buttons, html_map_callbacks
     
+    # Controllo e registrazione in un solo passo: un doppio tocco non invia la mappa due volte
+    with processing_callbacks_lock:
+        if callback_data in processing_callbacks:
+            print(f"Callback già in elaborazione: {callback_data}")
+            return False
+        processing_callbacks.add(callback_data)
+        
     try:
         # Controlla se è una richiesta di mappa HTML
         if callback_data in html_map_callbacks:
@@ -420,10 +1982,15 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
             map_info = html_map_callbacks[callback_data]
             html_file = map_info["file"]
             map_type = map_info["type"]
+            unit = units.get(map_info.get("unit_id"))
+            if unit is None:
+                print(f"Veicolo non trovato per il callback: {callback_data}")
+                return False
             
             # Messaggio di elaborazione
-            requests.post(
-                f"{TELEGRAM_API_URL}/answerCallbackQuery",
+            telegram.send(
+                "answerCallbackQuery",
+                wait=False,
                 json={
                     "callback_query_id": callback_id,
                     "text": f"Invio mappa HTML interattiva...",
@@ -434,8 +2001,8 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
             # Aggiorna il messaggio per rimuovere il pulsante
             if message_id is not None and chat_id is not None:
                 # Trova tutti i pulsanti di questo messaggio
-                if message_id in message_buttons:
-                    buttons_info = message_buttons[message_id].copy()
+                if (chat_id, message_id) in message_buttons:
+                    buttons_info = message_buttons[(chat_id, message_id)].copy()
                     
                     # Rimuovi il callback_data che stiamo processando
                     if callback_data in buttons_info:
@@ -464,8 +2031,10 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
                         try:
                             # Aggiorna il messaggio per rimuovere il pulsante
                             print(f"Aggiornamento messaggio {message_id} per rimuovere pulsante {callback_data}")
-                            requests.post(
-                                f"{TELEGRAM_API_URL}/editMessageReplyMarkup",
+                            telegram.send(
+                                "editMessageReplyMarkup",
+                                chat_id=chat_id,
+                                wait=False,
                                 json={
                                     "chat_id": chat_id,
                                     "message_id": message_id,
@@ -478,8 +2047,10 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
                         # Non ci sono più pulsanti, rimuovi completamente la keyboard
                         try:
                             print(f"Rimozione di tutti i pulsanti dal messaggio {message_id}")
-                            requests.post(
-                                f"{TELEGRAM_API_URL}/editMessageReplyMarkup",
+                            telegram.send(
+                                "editMessageReplyMarkup",
+                                chat_id=chat_id,
+                                wait=False,
                                 json={
                                     "chat_id": chat_id,
                                     "message_id": message_id,
@@ -490,33 +2061,36 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
                             print(f"Errore nella rimozione dei pulsanti: {e}")
                             
                     # Aggiorna il dizionario dei pulsanti di questo messaggio
-                    message_buttons[message_id] = buttons_info
+                    message_buttons[(chat_id, message_id)] = buttons_info
                     
                     # Se non ci sono più pulsanti, rimuovi l'intero messaggio dal dizionario
                     if not buttons_info:
-                        del message_buttons[message_id]
+                        del message_buttons[(chat_id, message_id)]
             
             # Invia la mappa interattiva come documento
             if os.path.exists(html_file):
                 caption = ""
                 if map_type == "position":
-                    caption = "🌐 Mappa interattiva della posizione attuale"
+                    caption = f"🌐 Mappa interattiva della posizione attuale{unit.title()}"
+                elif map_type == "window":
+                    caption = f"🌐 Mappa interattiva del percorso (ultime {map_info.get('hours', 0):g} ore){unit.title()}"
                 else:  # route
                     num_positions = map_info.get("num_positions", 0)
-                    caption = f"🌐 Mappa interattiva del percorso (ultime {num_positions} posizioni)"
+                    caption = f"🌐 Mappa interattiva del percorso (ultime {num_positions} posizioni){unit.title()}"
+                
+                # Se la stessa mappa è già stata caricata, Telegram la reinvia dal file_id
+                response = send_media(
+                    "sendDocument",
+                    "document",
+                    html_file,
+                    unit.chat_id,
+                    {
+                        'chat_id': unit.chat_id,
+                        'caption': caption,
+                        'parse_mode': 'Markdown'
+                    }
+                )
                 
-                with open(html_file, 'rb') as f:
-                    files = {'document': f}
-                    response = requests.post(
-                        f"{TELEGRAM_API_URL}/sendDocument",
-                        data={
-                            'chat_id': CHAT_ID,
-                            'caption': caption,
-                            'parse_mode': 'Markdown'
-                        },
-                        files=files
-                    )
-                    
                 if response.status_code != 200:
                     print(f"Errore nell'invio della mappa HTML: {response.text}")
                     return False
@@ -533,20 +2107,17 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
         # Procedi con i callback per le mappe di percorso
         if callback_data not in route_callbacks:
             print(f"Callback data non valido: {callback_data}")
-            return False
-            
-        # Controlla se questo callback è già in elaborazione
-        if callback_data in processing_callbacks:
-            print(f"Callback già in elaborazione: {callback_data}")
-            return False
-            
-        # Aggiungi questo callback all'insieme dei callback in elaborazione
-        processing_callbacks.add(callback_data)
+            return False
             
         # Invia un messaggio "in elaborazione"
-        num_positions = route_callbacks[callback_data]
-        requests.post(
-            f"{TELEGRAM_API_URL}/answerCallbackQuery",
+        num_positions = route_callbacks[callback_data]["num_positions"]
+        unit = units.get(route_callbacks[callback_data]["unit_id"])
+        if unit is None:
+            print(f"Veicolo non trovato per il callback: {callback_data}")
+            return False
+        telegram.send(
+            "answerCallbackQuery",
+            wait=False,
             json={
                 "callback_query_id": callback_id,
                 "text": f"Invio mappa con ultime {num_positions} posizioni...",
@@ -559,8 +2130,8 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
         # Se abbiamo message_id e chat_id, possiamo aggiornare il messaggio
         if message_id is not None and chat_id is not None:
             # Trova tutti i pulsanti di questo messaggio
-            if message_id in message_buttons:
-                buttons_info = message_buttons[message_id].copy()
+            if (chat_id, message_id) in message_buttons:
+                buttons_info = message_buttons[(chat_id, message_id)].copy()
                 
                 # Rimuovi il callback_data che stiamo processando
                 if callback_data in buttons_info:
@@ -589,8 +2160,10 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
                     try:
                         # Aggiorna il messaggio per rimuovere il pulsante
                         print(f"Aggiornamento messaggio {message_id} per rimuovere pulsante {callback_data}")
-                        requests.post(
-                            f"{TELEGRAM_API_URL}/editMessageReplyMarkup",
+                        telegram.send(
+                            "editMessageReplyMarkup",
+                            chat_id=chat_id,
+                            wait=False,
                             json={
                                 "chat_id": chat_id,
                                 "message_id": message_id,
@@ -603,8 +2176,10 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
                     # Non ci sono più pulsanti, rimuovi completamente la keyboard
                     try:
                         print(f"Rimozione di tutti i pulsanti dal messaggio {message_id}")
-                        requests.post(
-                            f"{TELEGRAM_API_URL}/editMessageReplyMarkup",
+                        telegram.send(
+                            "editMessageReplyMarkup",
+                            chat_id=chat_id,
+                            wait=False,
                             json={
                                 "chat_id": chat_id,
                                 "message_id": message_id,
@@ -615,135 +2190,302 @@ def process_callback_query(callback_data, callback_id, message_id=None, chat_id=
                         print(f"Errore nella rimozione dei pulsanti: {e}")
                         
                 # Aggiorna il dizionario dei pulsanti di questo messaggio
-                message_buttons[message_id] = buttons_info
+                message_buttons[(chat_id, message_id)] = buttons_info
                 
                 # Se non ci sono più pulsanti, rimuovi l'intero messaggio dal dizionario
                 if not buttons_info:
-                    del message_buttons[message_id]
+                    del message_buttons[(chat_id, message_id)]
         
         # Invia la mappa del percorso (già generata preventivamente)
-        result = send_route_map(num_positions)
-        
-        # Rimuovi il callback dall'insieme dei callback in elaborazione
-        processing_callbacks.remove(callback_data)
-        
-        return result
+        return send_route_map(unit, num_positions)
     except Exception as e:
-        # In caso di errore, assicurati di rimuovere il callback dall'insieme
-        if callback_data in processing_callbacks:
-            processing_callbacks.remove(callback_data)
         print(f"Errore nel processare il callback query: {e}")
         return False
+    finally:
+        # Rimuovi il callback dall'insieme dei callback in elaborazione (anche in caso di errore)
+        with processing_callbacks_lock:
+            processing_callbacks.discard(callback_data)
 
-def check_and_process_updates():
-    """Controlla e processa gli aggiornamenti da Telegram (callback query)"""
-    try:
-        # Ottieni gli aggiornamenti
-        response = requests.get(
-            f"{TELEGRAM_API_URL}/getUpdates",
-            params={
-                "offset": -1,  # Prendi solo l'ultimo aggiornamento
-                "timeout": 1
+def get_telegram_updates(offset):
+    """Attende nuovi aggiornamenti da Telegram con long polling a partire dall'offset indicato"""
+    response = telegram.request(
+        "getUpdates",
+        params={
+            "offset": offset,
+            "timeout": TELEGRAM_LONG_POLL_SECONDS,
+            "allowed_updates": json.dumps(TELEGRAM_ALLOWED_UPDATES)
+        },
+        timeout=TELEGRAM_LONG_POLL_SECONDS + 10
+    )
+    
+    # Un errore (token errato, conflitto 409, 5xx) deve far attendere il chiamante, non ripetere subito la richiesta
+    if response.status_code != 200:
+        raise RuntimeError(f"getUpdates HTTP {response.status_code}: {response.text}")
+        
+    data = response.json()
+    if not data.get("ok", False):
+        raise RuntimeError(f"getUpdates non riuscito: {data.get('description', data)}")
+    return data.get("result", [])
+
+def format_trips_message(unit, day, trips):
+    """Testo del messaggio con l'elenco dei viaggi di un giorno"""
+    lines = [f"VIAGGI DEL {day}{unit.title()}", ""]
+    for index, trip in enumerate(trips, 1):
+        start = str(trip["start_timestamp"])[11:16]
+        end = "in corso" if trip.get("ongoing") else str(trip["end_timestamp"])[11:16]
+        lines.append(
+            f"{index}. {start} -> {end}  {trip['distance_m'] / 1000:.1f} km  "
+            f"{trip['duration_s'] / 60:.0f} min  max {trip['max_speed']:.0f} km/h"
+        )
+    if not trips:
+        lines.append("Nessun viaggio registrato")
+    else:
+        total_km = sum(trip["distance_m"] for trip in trips) / 1000
+        lines += ["", f"Totale: {len(trips)} viaggi, {total_km:.1f} km"]
+    return "```\n" + "\n".join(lines) + "\n```"
+
+def command_trips(chat_id, args):
+    """/viaggi [AAAA-MM-GG|ieri]: elenco dei viaggi del giorno per i veicoli di questa chat"""
+    # I timestamp di Targa sono in UTC e i viaggi si filtrano sul loro giorno: anche "oggi" e "ieri" in UTC
+    now = datetime.now(timezone.utc)
+    day = now.strftime("%Y-%m-%d")
+    if args and args[0] == "ieri":
+        day = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    elif args:
+        day = args[0]
+    for unit in units_for_chat(chat_id):
+        telegram.send(
+            "sendMessage",
+            chat_id=chat_id,
+            json={
+                "chat_id": chat_id,
+                "text": format_trips_message(unit, day, get_trips(unit, day)),
+                "parse_mode": "Markdown"
             }
         )
+    return True
+
+def command_route_window(chat_id, args):
+    """/percorso [ore]: mappa del percorso delle ultime ore per i veicoli di questa chat"""
+    try:
+        hours = max(float(args[0]), 0.1) if args else ROUTE_WINDOW_DEFAULT_HOURS
+    except ValueError:
+        hours = ROUTE_WINDOW_DEFAULT_HOURS
+    # Estremi con fuso esplicito: i timestamp salvati sono UTC, l'ora locale del server non conta
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(hours=hours)
+    for unit in units_for_chat(chat_id):
+        output_file = os.path.join(unit.data_dir, "route_map_window.png")
+        interactive_file = os.path.join(unit.data_dir, "route_map_window.html")
+        count = generate_window_map(unit, start, end, output_file, interactive_file)
+        if not count:
+            telegram.send("sendMessage", chat_id=chat_id, json={
+                "chat_id": chat_id,
+                "text": f"Nessun percorso nelle ultime {hours:g} ore{unit.title()}"
+            })
+            continue
+            
+        # Pulsante per la versione interattiva, come per le altre mappe di percorso
+        html_callback = str(uuid.uuid4())
+        html_map_callbacks[html_callback] = {
+            "file": interactive_file,
+            "type": "window",
+            "hours": hours,
+            "unit_id": unit.unit_id
+        }
+        buttons_info = {html_callback: {"text": "🌐 Mappa HTML"}}
+        response = send_media("sendPhoto", "photo", output_file, chat_id, {
+            "chat_id": chat_id,
+            "caption": f"```\nROUTE MAP - LAST {hours:g} HOURS ({count} POSITIONS){unit.title()}\n```",
+            "parse_mode": "Markdown",
+            "reply_markup": json.dumps({"inline_keyboard": [[{"text": "🌐 Mappa HTML", "callback_data": html_callback}]]})
+        })
+        if response.status_code == 200:
+            save_message_buttons(response.json(), buttons_info)
+    return True
+
+# Comandi testuali del bot { comando: funzione(chat_id, argomenti) }
+TELEGRAM_COMMANDS = {
+    "/viaggi": command_trips,
+    "/percorso": command_route_window
+}
+
+def units_for_chat(chat_id):
+    return [unit for unit in units.values() if str(unit.chat_id) == str(chat_id)]
+
+def handle_telegram_command(message):
+    """Esegue un comando testuale (/comando argomenti) ricevuto in una chat dei veicoli"""
+    text = (message.get("text") or "").strip()
+    if not text.startswith("/"):
+        return False
+    command, *args = text.split()
+    command = command.split("@")[0].lower()  # /comando@nome_bot nei gruppi
+    chat_id = message.get("chat", {}).get("id")
+    handler = TELEGRAM_COMMANDS.get(command)
+    if handler is None or not units_for_chat(chat_id):
+        return False
+    print(f"Ricevuto comando {command} dalla chat {chat_id}")
+    return handler(chat_id, args)
+
+def handle_telegram_update(update):
+    """Processa un singolo aggiornamento Telegram (callback query dei pulsanti o comando testuale)"""
+    try:
+        message = update.get("message") or update.get("channel_post")
+        if message is not None:
+            return handle_telegram_command(message)
+            
+        if "callback_query" not in update:
+            return False
+            
+        callback_query = update["callback_query"]
+        callback_id = callback_query["id"]
+        callback_data = callback_query.get("data", "")
         
-        if response.status_code != 200:
-            print(f"Errore nel controllo degli aggiornamenti Telegram: {response.text}")
+        # Estrai informazioni sul messaggio
+        message = callback_query.get("message", {})
+        message_id = message.get("message_id")
+        chat_id = message.get("chat", {}).get("id")
+        
+        print(f"Ricevuto callback query: {callback_data} dal messaggio {message_id}")
+        
+        # Processa il callback con informazioni sul messaggio
+        return process_callback_query(callback_data, callback_id, message_id, chat_id)
+    except Exception as e:
+        print(f"Errore nel processare l'aggiornamento Telegram: {e}")
+        return False
+
+# Aggiornamenti del long polling ricevuti ma non ancora gestiti { update_id: update }, salvati in
+# tracker_state.db prima che la richiesta successiva li confermi a Telegram, e ultimo update_id ricevuto
+pending_updates = {}
+pending_updates_last = None
+pending_updates_lock = threading.Lock()
+
+def save_pending_updates():
+    """Salva gli aggiornamenti in corso e l'offset: il primo non ancora gestito (o il successivo all'ultimo ricevuto)"""
+    offset = min(pending_updates) if pending_updates else pending_updates_last + 1
+    set_state_value("telegram_pending", [pending_updates[update_id] for update_id in sorted(pending_updates)])
+    set_state_value("telegram_offset", offset)
+    return offset
+
+def begin_updates(updates):
+    """Registra un blocco di aggiornamenti prima di gestirli"""
+    global pending_updates_last
+    with pending_updates_lock:
+        for update in updates:
+            pending_updates[update["update_id"]] = update
+            pending_updates_last = max(update["update_id"], pending_updates_last or 0)
+        save_pending_updates()
+
+def process_update(update):
+    """Gestisce un aggiornamento e poi lo toglie da quelli in corso: l'offset salvato avanza solo
+    sulla sequenza contigua di aggiornamenti già gestiti"""
+    try:
+        return handle_telegram_update(update)
+    finally:
+        with pending_updates_lock:
+            pending_updates.pop(update["update_id"], None)
+            offset = save_pending_updates()
+        print(f"Aggiornamenti Telegram confermati fino a {offset - 1}")
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Riceve gli aggiornamenti inviati da Telegram (POST con il JSON dell'update)"""
+    
+    def do_POST(self):
+        received_secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if TELEGRAM_WEBHOOK_SECRET and not hmac.compare_digest(received_secret, TELEGRAM_WEBHOOK_SECRET):
+            self.send_error(403)
             return
             
-        data = response.json()
-        
-        # Controlla se ci sono callback query
-        if not data.get("ok", False) or "result" not in data or not data["result"]:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = json.loads(self.rfile.read(length))
+            if not isinstance(update, dict):
+                raise ValueError("update non valido")
+        except ValueError:
+            self.send_error(400)
             return
             
-        for update in data["result"]:
-            if "callback_query" in update:
-                callback_query = update["callback_query"]
-                callback_id = callback_query["id"]
-                callback_data = callback_query.get("data", "")
-                
-                # Estrai informazioni sul messaggio
-                message = callback_query.get("message", {})
-                message_id = message.get("message_id")
-                chat_id = message.get("chat", {}).get("id")
-                
-                print(f"Ricevuto callback query: {callback_data} dal messaggio {message_id}")
-                
-                # Processa il callback con informazioni sul messaggio
-                process_result = process_callback_query(callback_data, callback_id, message_id, chat_id)
-                
-                # Se il callback è stato elaborato con successo, 
-                # conferma e segna l'aggiornamento come letto
-                if process_result:
-                    # Ottieni l'update_id
-                    update_id = update.get("update_id", 0)
-                    if update_id > 0:
-                        # Segna come letto usando l'offset
-                        requests.get(
-                            f"{TELEGRAM_API_URL}/getUpdates",
-                            params={"offset": update_id + 1}
-                        )
-                        print(f"Aggiornamento {update_id} segnato come letto")
-    except Exception as e:
-        print(f"Errore nel controllo degli aggiornamenti Telegram: {e}")
+        # Risposta immediata: Telegram non ritenta e il callback viene processato in background
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        callback_executor.submit(handle_telegram_update, update)
+        
+    def log_message(self, format, *args):
+        pass  # Gli aggiornamenti vengono già registrati da handle_telegram_update
+
+def start_webhook_server():
+    """Avvia il server che riceve i pulsanti da Telegram e, se configurato, registra il webhook"""
+    global webhook_server, TELEGRAM_WEBHOOK_SECRET
+    host = TELEGRAM_WEBHOOK_HOST
+    if not TELEGRAM_WEBHOOK_SECRET:
+        if TELEGRAM_WEBHOOK_URL:
+            # Il segreto viene registrato con setWebhook a ogni avvio: uno casuale basta a
+            # rifiutare gli aggiornamenti falsificati da chi raggiunge la porta
+            TELEGRAM_WEBHOOK_SECRET = secrets.token_urlsafe(32)
+            print("TELEGRAM_WEBHOOK_SECRET non impostato: generato un segreto casuale per questo avvio")
+        else:
+            # Senza segreto né registrazione (test locali) il server accetta solo connessioni locali
+            host = "127.0.0.1"
+            print("TELEGRAM_WEBHOOK_SECRET non impostato: server webhook limitato a 127.0.0.1")
+    webhook_server = ThreadingHTTPServer((host, TELEGRAM_WEBHOOK_PORT), WebhookRequestHandler)
+    webhook_server.daemon_threads = True
+    threading.Thread(target=webhook_server.serve_forever, daemon=True).start()
+    print(f"Server webhook Telegram avviato su {host}:{webhook_server.server_address[1]}")
+    
+    if not TELEGRAM_WEBHOOK_URL:
+        print("TELEGRAM_WEBHOOK_URL non impostato: webhook non registrato su Telegram")
+        return True
+        
+    data = {
+        "url": TELEGRAM_WEBHOOK_URL,
+        "allowed_updates": json.dumps(TELEGRAM_ALLOWED_UPDATES),
+        "secret_token": TELEGRAM_WEBHOOK_SECRET
+    }
+    response = telegram.request("setWebhook", data=data)
+    if response.status_code != 200:
+        print(f"Errore nella registrazione del webhook: {response.text}")
+        return False
+    print(f"Webhook registrato: {TELEGRAM_WEBHOOK_URL}")
+    return True
 
-def generate_map_image(lat, lon, address):
+def generate_map_image(unit, lat, lon, address, backend=None):
     """Genera un'immagine della mappa con la posizione del veicolo e le posizioni precedenti"""
     try:
         print("Generazione mappa della posizione...")
         
-        # Carica le posizioni precedenti (massimo 20)
-        positions = []
-        try:
-            if os.path.exists(csv_file):
-                positions_df = pd.read_csv(csv_file)
-                # Ordina per timestamp in ordine decrescente per avere le più recenti prima
-                positions_df = positions_df.sort_values(by='timestamp', ascending=False)
-                # Prendi solo le ultime 20 posizioni
-                positions_df = positions_df.head(20)
-                # Riordina per timestamp in ordine crescente per il percorso
-                positions_df = positions_df.sort_values(by='timestamp', ascending=True)
-                
-                for _, position in positions_df.iterrows():
-                    positions.append({
-                        'lat': position['lat'],
-                        'lon': position['lon'],
-                        'timestamp': position['timestamp'],
-                        'via': position['via'] if pd.notna(position['via']) else '',
-                        'comune': position['comune'] if pd.notna(position['comune']) else ''
-                    })
-        except Exception as e:
-            print(f"Errore nel caricamento delle posizioni precedenti: {e}")
+        # Posizioni precedenti (massimo 20) dal buffer in memoria, in ordine cronologico
+        positions = [
+            {
+                'lat': position['lat'],
+                'lon': position['lon'],
+                'timestamp': position['timestamp'],
+                'via': position.get('via') or '',
+                'comune': position.get('comune') or ''
+            }
+            for position in get_recent_positions(unit, 20)
+        ]
         
         # Se non ci sono posizioni precedenti o è la prima posizione, usa solo la posizione attuale
         if not positions or len(positions) < 2:
-            # Crea una mappa centrata sulla posizione attuale con zoom 18 (molto ravvicinato)
-            m = folium.Map(location=[lat, lon], zoom_start=18, tiles='CartoDB positron')
+            # Mappa centrata sulla posizione attuale con zoom 18 (molto ravvicinato)
+            spec = new_map_spec([lat, lon], 18)
             
             # Aggiungi un marker per la posizione
-            folium.CircleMarker(
-                [lat, lon], 
-                radius=10,
-                color='red',
-                fill=True,
-                fill_color='red',
-                fill_opacity=0.7,
-                popup=address
-            ).add_to(m)
+            spec["layers"].append({
+                "type": "circle_marker", "location": [lat, lon],
+                "radius": 10, "color": "red", "fill_opacity": 0.7, "popup": address
+            })
             
-            # Aggiungi un cerchio più ampio per indicare l'area
-            folium.Circle(
-                [lat, lon],
-                radius=25,  # 25 metri di raggio per uno zoom più stretto
-                color='blue',
-                fill=True,
-                fill_opacity=0.1
-            ).add_to(m)
+            # Aggiungi un cerchio più ampio per indicare l'area (25 metri di raggio per uno zoom più stretto)
+            spec["layers"].append({
+                "type": "circle", "location": [lat, lon],
+                "radius_m": 25, "color": "blue", "fill_opacity": 0.1
+            })
         else:
             # Usa l'ultima posizione come centro della mappa con zoom forte (17-18)
             # Questo assicura che la mappa sia centrata sull'ultima posizione con uno zoom forte
-            m = folium.Map(location=[lat, lon], zoom_start=17, tiles='CartoDB positron')
+            spec = new_map_spec([lat, lon], 17)
             
             # Crea una lista di punti per il percorso
             route_points = []
@@ -773,15 +2515,10 @@ def generate_map_image(lat, lon, address):
                 
                 # Aggiungi un marker per ogni posizione precedente (non l'ultima)
                 if i < len(positions) - 1:
-                    folium.CircleMarker(
-                        [pos_lat, pos_lon], 
-                        radius=6,
-                        color='blue',
-                        fill=True,
-                        fill_color='blue',
-                        fill_opacity=0.7,
-                        popup=popup_text
-                    ).add_to(m)
+                    spec["layers"].append({
+                        "type": "circle_marker", "location": [pos_lat, pos_lon],
+                        "radius": 6, "color": "blue", "fill_opacity": 0.7, "popup": popup_text
+                    })
                     
                     # Aggiungi label con l'orario solo per alcune posizioni per non sovraffollare la mappa
                     # Per poche posizioni: mostra tutti gli orari
@@ -789,79 +2526,41 @@ def generate_map_image(lat, lon, address):
                     show_label = (len(positions) <= 5) or (i % 5 == 0) or (i == 0)
                     
                     if show_label:
-                        folium.map.Marker(
-                            [pos_lat, pos_lon],
-                            icon=folium.DivIcon(
-                                icon_size=(60, 20),
-                                icon_anchor=(30, -10),
-                                html=f'<div style="font-size: 10pt; color: black; background-color: white; border: 1px solid black; border-radius: 3px; padding: 1px 3px; text-align: center;">{formatted_time}</div>'
-                            )
-                        ).add_to(m)
+                        spec["layers"].append({"type": "label", "location": [pos_lat, pos_lon], "text": formatted_time})
             
             # Aggiungi la linea del percorso
             if len(route_points) > 1:
-                folium.PolyLine(
-                    route_points,
-                    color='blue',
-                    weight=3,
-                    opacity=0.8
-                ).add_to(m)
+                spec["layers"].append({
+                    "type": "polyline", "locations": route_points,
+                    "color": "blue", "weight": 3, "opacity": 0.8
+                })
             
             # Aggiungi un marker più grande per l'ultima posizione (posizione attuale)
-            folium.CircleMarker(
-                [lat, lon], 
-                radius=10,
-                color='red',
-                fill=True,
-                fill_color='red',
-                fill_opacity=0.7,
-                popup=address
-            ).add_to(m)
-        
-        # Salva la mappa come HTML temporaneo
-        map_html = f"temp_map_{int(time.time())}.html"
-        m.save(map_html)
-        
-        # Salva anche la versione interattiva permanente
-        m.save(interactive_map_file)
-        print(f"Mappa interattiva salvata come {interactive_map_file}")
-        
-        # Configura Chrome in modalità headless per il rendering
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--window-size=800,600")
-        
-        # Crea un driver browser
-        driver = webdriver.Chrome(options=chrome_options)
-        driver.get(f"file://{os.path.abspath(map_html)}")
-        
-        # Aspetta che la mappa sia caricata completamente
-        time.sleep(2)
-        
-        # Cattura lo screenshot
-        driver.save_screenshot(map_file)
+            spec["layers"].append({
+                "type": "circle_marker", "location": [lat, lon],
+                "radius": 10, "color": "red", "fill_opacity": 0.7, "popup": address
+            })
         
-        # Chiudi il browser e rimuovi il file temporaneo
-        driver.quit()
-        os.remove(map_html)
+        # Versione interattiva permanente e immagine (dalla cache se la mappa è identica)
+        if not render_map_cached(unit, spec, "position", unit.map_file, unit.interactive_map_file, backend):
+            return False
         
-        print(f"Mappa salvata come {map_file}")
+        print(f"Mappa salvata come {unit.map_file} e {unit.interactive_map_file}")
         return True
     except Exception as e:
         print(f"Errore nella generazione della mappa: {e}")
         return False
 
-def send_position_update(lat, lon, address, timestamp, speed, battery):
+def send_position_update(unit, lat, lon, address, timestamp, speed, battery):
     """Invia un messaggio con la posizione attuale e la mappa"""
     try:
         # Genera immagine della mappa
-        if not generate_map_image(lat, lon, address):
+        if not generate_map_image(unit, lat, lon, address):
             print("Impossibile generare la mappa, invio solo il messaggio con la posizione")
         
         # Conta quante posizioni sono disponibili e usate nella mappa
-        num_positions = min(count_available_positions(), 20)
+        total_positions = count_available_positions(unit)
+        num_positions = min(total_positions, 20)
         
         # Riformatta il timestamp in un formato più leggibile
         try:
@@ -874,7 +2573,7 @@ def send_position_update(lat, lon, address, timestamp, speed, battery):
             formatted_timestamp = timestamp
         
         # Formatta il messaggio in stile cyber/tecnico con font monospazio
-        message = f"```\nPOSITION UPDATE\n\n"
+        message = f"```\nPOSITION UPDATE{unit.title()}\n\n"
         message += f"📍 {address}\n\n"
         message += f"TIMESTAMP: {formatted_timestamp}\n"
         message += f"BATTERY: {battery}\n"
@@ -892,12 +2591,13 @@ def send_position_update(lat, lon, address, timestamp, speed, battery):
         buttons_info = {}  # { callback_data: info }
         
         # Aggiungi pulsante per la mappa HTML
-        if os.path.exists(interactive_map_file):
+        if os.path.exists(unit.interactive_map_file):
             html_callback = str(uuid.uuid4())
             html_map_callbacks[html_callback] = {
-                "file": interactive_map_file,
+                "file": unit.interactive_map_file,
                 "type": "position",
-                "num_positions": num_positions
+                "num_positions": num_positions,
+                "unit_id": unit.unit_id
             }
             buttons.append({
                 "text": "🌐 Mappa HTML",
@@ -910,9 +2610,9 @@ def send_position_update(lat, lon, address, timestamp, speed, battery):
         # Non è necessario aggiungere pulsanti per visualizzare la mappa con più posizioni
         # poiché ora la mappa mostra già il massimo delle posizioni disponibili
         # Manteniamo solo il pulsante per le ultime 20 posizioni se abbiamo più di 20 posizioni
-        if count_available_positions() > 20:
+        if total_positions > 20:
             callback_20 = str(uuid.uuid4())
-            route_callbacks[callback_20] = 20
+            route_callbacks[callback_20] = {"num_positions": 20, "unit_id": unit.unit_id}
             buttons_info[callback_20] = 20
             buttons.append({
                 "text": "🗺️ Ultime 20",
@@ -927,35 +2627,26 @@ def send_position_update(lat, lon, address, timestamp, speed, battery):
             })
         
         # Invia foto con didascalia e pulsanti e salva il message_id
-        message_id = None
-        if os.path.exists(map_file):
-            with open(map_file, 'rb') as photo:
-                files = {'photo': photo}
-                data = {
-                    'chat_id': CHAT_ID,
-                    'caption': message,
-                    'parse_mode': 'Markdown',
-                }
-                
-                # Aggiungi pulsanti solo se disponibili
-                if inline_keyboard:
-                    data['reply_markup'] = inline_keyboard
-                
-                response = requests.post(
-                    f"{TELEGRAM_API_URL}/sendPhoto",
-                    data=data,
-                    files=files
-                )
-                
-                # Estrai il message_id dalla risposta
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if response_data.get("ok", False) and "result" in response_data:
-                        message_id = response_data["result"].get("message_id")
+        response_data = {}
+        if os.path.exists(unit.map_file):
+            data = {
+                'chat_id': unit.chat_id,
+                'caption': message,
+                'parse_mode': 'Markdown',
+            }
+            
+            # Aggiungi pulsanti solo se disponibili
+            if inline_keyboard:
+                data['reply_markup'] = inline_keyboard
+            
+            response = send_media("sendPhoto", "photo", unit.map_file, unit.chat_id, data)
+            
+            if response.status_code == 200:
+                response_data = response.json()
         else:
             # Fallback: invia solo messaggio testuale con pulsanti
             data = {
-                'chat_id': CHAT_ID,
+                'chat_id': unit.chat_id,
                 'text': message,
                 'parse_mode': 'Markdown',
             }
@@ -964,24 +2655,16 @@ def send_position_update(lat, lon, address, timestamp, speed, battery):
             if inline_keyboard:
                 data['reply_markup'] = inline_keyboard
                 
-            response = requests.post(
-                f"{TELEGRAM_API_URL}/sendMessage",
-                json=data
-            )
+            response = telegram.send("sendMessage", chat_id=unit.chat_id, json=data)
             
-            # Estrai il message_id dalla risposta
             if response.status_code == 200:
                 response_data = response.json()
-                if response_data.get("ok", False) and "result" in response_data:
-                    message_id = response_data["result"].get("message_id")
             
         if response.status_code == 200:
             print("Aggiornamento posizione inviato con successo")
             
-            # Se abbiamo il message_id e ci sono pulsanti, salva le informazioni
-            if message_id is not None and buttons_info:
-                message_buttons[message_id] = buttons_info
-                print(f"Salvati pulsanti per il messaggio {message_id}: {buttons_info}")
+            # Se ci sono pulsanti, salva le informazioni del messaggio
+            save_message_buttons(response_data, buttons_info)
                 
             return True
         else:
@@ -991,80 +2674,359 @@ def send_position_update(lat, lon, address, timestamp, speed, battery):
         print(f"Errore nell'invio dell'aggiornamento della posizione: {e}")
         return False
 
-def send_telegram_files():
+def send_telegram_files(unit):
     try:
-        global last_sent_hash, updates_since_last_send
-        
-        # Verifica se ci sono stati aggiornamenti dal precedente invio
-        if not updates_since_last_send:
+        # Il numero progressivo dell'ultima posizione è il token di modifica: nessun file da rileggere
+        last_seq = get_last_sequence(unit)
+        sent_key = f"last_sent_seq:{unit.unit_id}"
+        last_sent_seq = get_state_value(sent_key, 0)
+        if last_seq <= last_sent_seq:
             print("Nessun aggiornamento dai file precedentemente inviati, salto l'invio")
             return False
             
-        # Calcola hash dei file per verificare se sono cambiati
-        current_hash = ""
-        for file_path in [csv_file, txt_file]:
-            if os.path.exists(file_path):
-                with open(file_path, 'rb') as f:
-                    current_hash += hashlib.md5(f.read()).hexdigest()
-        
-        # Se l'hash è identico all'ultimo invio, non invia nulla
-        if current_hash == last_sent_hash:
-            print("I file non sono cambiati dall'ultimo invio, salto l'invio")
+        if FILES_EXPORT_MODE == "archive":
+            # Solo i segmenti giornalieri che hanno ricevuto nuove posizioni
+            days = changed_archive_days(unit, last_sent_seq, last_seq)
+            files = [export_archive_segment(unit, day) for day in days]
+            print(f"Segmenti dell'archivio da inviare: {', '.join(days)}")
+            timestamp = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+            response = send_documents(unit.chat_id, files, f"```\nDATA ARCHIVE{unit.title()} - {timestamp}\n```")
+            if response.status_code == 200:
+                print(f"{len(files)} segmenti dell'archivio inviati con successo su Telegram")
+                set_state_value(sent_key, last_seq)
+                return True
+            print(f"Errore nell'invio dei segmenti dell'archivio: {response.text}")
             return False
             
-        # Aggiorna l'hash
-        last_sent_hash = current_hash
+        if FILES_EXPORT_MODE == "delta":
+            # Solo le posizioni aggiunte dall'ultimo invio riuscito
+            files = [unit.delta_csv_file, unit.delta_txt_file]
+            since_seq = last_sent_seq
+            title = f"DATA UPDATE{unit.title()} - {last_seq - last_sent_seq} nuove posizioni"
+        else:
+            files = [unit.csv_file, unit.txt_file]
+            since_seq = None
+            title = f"DATA UPDATE{unit.title()}"
             
-        # Prepara i file per l'invio
-        media = []
+        # Esporta in CSV e TXT solo ora che serve inviarli, fino all'ultima posizione letta sopra
+        if (not export_positions_csv(unit, files[0], since_seq, last_seq)
+                or not export_positions_txt(unit, files[1], since_seq, last_seq)):
+            return False
+            
+        # Invia entrambi i file in un unico messaggio (il CSV con la descrizione in monospazio)
         timestamp = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+        response = send_document_group(unit.chat_id, files, f"```\n{title} - {timestamp}\n```")
         
-        # Aggiungi il file CSV (primo file con descrizione)
-        with open(csv_file, 'rb') as csv:
-            media.append({
-                'type': 'document',
-                'media': f'attach://{csv_file}',
-                'caption': f"```\nDATA UPDATE - {timestamp}\n```"  # Descrizione in monospazio
-            })
-            files = {csv_file: csv}
+        if response.status_code == 200:
+            print("File inviati con successo su Telegram in un unico messaggio")
+            # Il prossimo invio riparte da qui (salvato anche tra un riavvio e l'altro)
+            set_state_value(sent_key, last_seq)
+            return True
+        else:
+            print(f"Errore nell'invio dei file: {response.text}")
+            return False
             
-            # Aggiungi il file TXT (secondo file senza descrizione)
-            with open(txt_file, 'rb') as txt:
-                media.append({
-                    'type': 'document',
-                    'media': f'attach://{txt_file}'
-                    # Nessun campo caption per il secondo file
-                })
-                files[txt_file] = txt
-                
-                # Invia entrambi i file in un unico messaggio
-                response = requests.post(
-                    f"{TELEGRAM_API_URL}/sendMediaGroup",
-                    data={
-                        'chat_id': CHAT_ID,
-                        'media': json.dumps(media),
-                        'parse_mode': 'Markdown'
-                    },
-                    files=files
-                )
-                
-                if response.status_code == 200:
-                    print("File inviati con successo su Telegram in un unico messaggio")
-                    updates_since_last_send = False  # Resetta il flag degli aggiornamenti
-                    return True
-                else:
-                    print(f"Errore nell'invio dei file: {response.text}")
-                    return False
-                    
     except Exception as e:
         print(f"Errore nell'invio dei file su Telegram: {e}")
         return False
 
+def get_state_db():
+    """Restituisce la connessione al database di stato (cache e dati di servizio), creandolo se necessario"""
+    global state_db_conn
+    with state_db_lock:
+        if state_db_conn is None:
+            conn = sqlite3.connect(state_db_file, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocode_cache (
+                    cell TEXT PRIMARY KEY,
+                    via TEXT,
+                    comune TEXT,
+                    provincia TEXT,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            # file_id di Telegram dei contenuti già caricati (chiave: hash del contenuto)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    hash TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (hash, kind)
+                )
+            """)
+            # Pulsanti inviati (registri di CallbackRegistry), con indice per la scadenza
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS callbacks (
+                    registry TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (registry, key)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_callbacks_created_at ON callbacks (created_at)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS kv (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+            conn.commit()
+            state_db_conn = conn
+    return state_db_conn
+
+def get_state_value(key, default=None):
+    """Legge un valore (JSON) dal database di stato"""
+    conn = get_state_db()
+    with state_db_lock:
+        row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row is not None else default
+
+def set_state_value(key, value):
+    """Salva un valore (JSON) nel database di stato"""
+    conn = get_state_db()
+    with state_db_lock:
+        conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        conn.commit()
+
+def read_media(path):
+    """Legge una sola volta il file da inviare: hash e caricamento usano gli stessi byte,
+    anche se nel frattempo un altro thread riscrive il file (mappe condivise)"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    return content, hashlib.sha256(content).hexdigest()
+
+def media_upload(path, content):
+    """Contenuto già letto, pronto per il caricamento con il nome del file originale"""
+    upload = io.BytesIO(content)
+    upload.name = path
+    return upload
+
+def get_media_file_id(content_hash, kind):
+    """file_id di Telegram di un contenuto già caricato (None se mai caricato)"""
+    conn = get_state_db()
+    with state_db_lock:
+        row = conn.execute(
+            "SELECT file_id FROM media_cache WHERE hash = ? AND kind = ?", (content_hash, kind)
+        ).fetchone()
+    return row[0] if row is not None else None
+
+def store_media_file_id(content_hash, kind, file_id):
+    conn = get_state_db()
+    with state_db_lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO media_cache (hash, kind, file_id, created_at) VALUES (?, ?, ?, ?)",
+            (content_hash, kind, file_id, time.time())
+        )
+        conn.commit()
+
+def forget_media_file_id(content_hash, kind):
+    conn = get_state_db()
+    with state_db_lock:
+        conn.execute("DELETE FROM media_cache WHERE hash = ? AND kind = ?", (content_hash, kind))
+        conn.commit()
+
+def uploaded_file_id(message, kind):
+    """Estrae il file_id dal messaggio restituito da Telegram (per le foto la versione più grande)"""
+    if kind == "photo":
+        photos = message.get("photo") or []
+        return photos[-1]["file_id"] if photos else None
+    return (message.get(kind) or {}).get("file_id")
+
+def send_media(method, kind, path, chat_id, data):
+    """Invia una foto o un documento, riusando il file_id se lo stesso contenuto è già stato caricato"""
+    content, content_hash = read_media(path)
+    file_id = get_media_file_id(content_hash, kind)
+    if file_id is not None:
+        response = telegram.send(method, chat_id=chat_id, data={**data, kind: file_id})
+        if response.status_code == 200:
+            print(f"Riutilizzato il file_id di Telegram per {path}")
+            return response
+        # file_id non più valido: si torna al caricamento del file
+        print(f"file_id non valido per {path}, ricarico il file: {response.text}")
+        forget_media_file_id(content_hash, kind)
+        
+    response = telegram.send(method, chat_id=chat_id, data=data, files={kind: media_upload(path, content)})
+    if response.status_code == 200:
+        file_id = uploaded_file_id(response.json().get("result", {}), kind)
+        if file_id:
+            store_media_file_id(content_hash, kind, file_id)
+    return response
+
+def send_document_group(chat_id, paths, caption):
+    """Invia più documenti in un unico messaggio, caricando solo quelli mai inviati prima"""
+    contents = [read_media(path) for path in paths]
+    hashes = [content_hash for _, content_hash in contents]
+    
+    def build_request(use_cache):
+        media = []
+        files = {}
+        for index, (path, (content, content_hash)) in enumerate(zip(paths, contents)):
+            file_id = get_media_file_id(content_hash, "document") if use_cache else None
+            if file_id is None:
+                name = os.path.basename(path)
+                files[name] = media_upload(path, content)
+                file_id = f'attach://{name}'
+            item = {'type': 'document', 'media': file_id}
+            if index == 0 and caption:
+                item['caption'] = caption  # Solo il primo file ha la descrizione
+            media.append(item)
+        return media, files
+        
+    for use_cache in (True, False):
+        media, files = build_request(use_cache)
+        response = telegram.send(
+            "sendMediaGroup",
+            chat_id=chat_id,
+            data={
+                'chat_id': chat_id,
+                'media': json.dumps(media),
+                'parse_mode': 'Markdown'
+            },
+            files=files
+        )
+        
+        if response.status_code == 200:
+            for message, content_hash in zip(response.json().get("result", []), hashes):
+                file_id = uploaded_file_id(message, "document")
+                if file_id:
+                    store_media_file_id(content_hash, "document", file_id)
+            return response
+        if len(files) == len(paths):
+            break  # Tutti i file erano già in caricamento: il file_id non c'entra
+        # Qualche file_id non è più valido: li dimentica e riprova caricando tutto
+        print(f"Invio con file_id fallito, ricarico i file: {response.text}")
+        for content_hash in hashes:
+            forget_media_file_id(content_hash, "document")
+    return response
+
+def send_documents(chat_id, paths, caption):
+    """Invia uno o più documenti (gruppi da massimo 10), la descrizione solo sul primo messaggio"""
+    response = None
+    for start in range(0, len(paths), 10):
+        chunk = paths[start:start + 10]
+        chunk_caption = caption if start == 0 else ""
+        if len(chunk) == 1:
+            # sendMediaGroup richiede almeno due elementi
+            data = {'chat_id': chat_id, 'parse_mode': 'Markdown'}
+            if chunk_caption:
+                data['caption'] = chunk_caption
+            response = send_media("sendDocument", "document", chunk[0], chat_id, data)
+        else:
+            response = send_document_group(chat_id, chunk, chunk_caption)
+        if response.status_code != 200:
+            break
+    return response
+
+def geohash_encode(lat, lon, precision):
+    """Calcola il geohash delle coordinate (cella spaziale usata come chiave della cache)"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value_range, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+def load_geocode_cache():
+    """Carica in memoria le voci non scadute della cache di geocoding (una sola volta)"""
+    global geocode_cache_loaded
+    if geocode_cache_loaded:
+        return
+    conn = get_state_db()
+    with state_db_lock:
+        conn.execute("DELETE FROM geocode_cache WHERE created_at < ?", (time.time() - GEOCODE_CACHE_TTL,))
+        conn.commit()
+        rows = conn.execute(
+            "SELECT cell, via, comune, provincia, created_at FROM geocode_cache ORDER BY last_access DESC LIMIT ?",
+            (GEOCODE_CACHE_MAX_ENTRIES,)
+        ).fetchall()
+    # Dalla meno recente alla più recente, come si aspetta l'ordine LRU
+    for cell, via, comune, provincia, created_at in reversed(rows):
+        geocode_cache[cell] = ({'via': via, 'comune': comune, 'provincia': provincia}, created_at)
+    geocode_cache_loaded = True
+    print(f"Cache di geocoding: caricati {len(geocode_cache)} indirizzi")
+
+def get_cached_address(cell):
+    """Cerca un indirizzo nella cache in memoria, None se assente o scaduto"""
+    with geocode_cache_lock:
+        load_geocode_cache()
+        entry = geocode_cache.get(cell)
+        if entry is None:
+            return None
+        result, created_at = entry
+        if time.time() - created_at > GEOCODE_CACHE_TTL:
+            del geocode_cache[cell]
+            return None
+        geocode_cache.move_to_end(cell)
+        return dict(result)
+
+def store_cached_address(cell, result):
+    """Salva un indirizzo nella cache (memoria e database) con evizione LRU"""
+    now = time.time()
+    with geocode_cache_lock:
+        load_geocode_cache()
+        geocode_cache[cell] = (dict(result), now)
+        geocode_cache.move_to_end(cell)
+        evicted = []
+        while len(geocode_cache) > GEOCODE_CACHE_MAX_ENTRIES:
+            evicted.append(geocode_cache.popitem(last=False)[0])
+            
+    conn = get_state_db()
+    with state_db_lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO geocode_cache (cell, via, comune, provincia, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+            (cell, result['via'], result['comune'], result['provincia'], now, now)
+        )
+        conn.executemany("DELETE FROM geocode_cache WHERE cell = ?", [(cell,) for cell in evicted])
+        conn.commit()
+
+def get_reverse_geocoder():
+    """Restituisce il geocoder Nominatim condiviso, limitato a una richiesta al secondo"""
+    global reverse_geocoder
+    # Creato sotto lock: i thread della flotta devono condividere un solo limitatore
+    with reverse_geocoder_lock:
+        if reverse_geocoder is None:
+            geolocator = Nominatim(user_agent="tracker_app")
+            # Policy di Nominatim: al massimo una richiesta al secondo
+            reverse_geocoder = RateLimiter(
+                geolocator.reverse,
+                min_delay_seconds=NOMINATIM_MIN_DELAY,
+                max_retries=0,
+                swallow_exceptions=False
+            )
+        return reverse_geocoder
+
 def get_address(lat, lon):
-    geolocator = Nominatim(user_agent="tracker_app")
+    # Le coordinate vicine (stessa cella geohash) condividono l'indirizzo già trovato
+    cell = geohash_encode(lat, lon, GEOCODE_CACHE_PRECISION)
+    cached = get_cached_address(cell)
+    if cached is not None:
+        print(f"Indirizzo dalla cache di geocoding ({cell}): {cached}")
+        return cached
+        
     try:
         print(f"Richiesta geocoding per coordinate: {lat}, {lon}")
-        location = geolocator.reverse(f"{lat}, {lon}", language='it')
+        location = get_reverse_geocoder()(f"{lat}, {lon}", language='it')
         if location:
             address = location.raw.get('address', {})
             result = {
@@ -1073,6 +3035,7 @@ def get_address(lat, lon):
                 'provincia': address.get('state', '')
             }
             print(f"Indirizzo trovato: {result}")
+            store_cached_address(cell, result)
             return result
         else:
             print("Nessun risultato trovato per queste coordinate")
@@ -1096,46 +3059,131 @@ def get_formatted_address(via, comune, provincia):
         return ", ".join(parts)
     return "Indirizzo sconosciuto"
 
-def save_to_txt(df):
-    try:
-        # Ordina il DataFrame per timestamp in ordine decrescente (più recenti prima)
-        df_sorted = df.sort_values(by='timestamp', ascending=False)
-        
-        with open(txt_file, 'w', encoding='utf-8') as f:
-            f.write("REGISTRO POSIZIONI VEICOLO\n")
-            f.write("=" * 50 + "\n\n")
-            
-            for _, row in df_sorted.iterrows():
-                f.write(f"Data/Ora: {row['timestamp']}\n")
-                f.write(f"Coordinate: {row['lat']}, {row['lon']}\n")
-                f.write(f"Velocità: {row['speed']} km/h\n")
-                f.write(f"Chilometraggio: {row['mileage']} km\n")
-                f.write(f"Via: {row['via']}\n")
-                f.write(f"Comune: {row['comune']}\n")
-                f.write(f"Provincia: {row['provincia']}\n")
-                f.write(f"Batteria: {row['battery']} V\n")
-                f.write(f"Descrizione: {row['description']}\n")
-                f.write("-" * 50 + "\n\n")
-                
-        print(f"File {txt_file} aggiornato con successo")
-        return True
-    except Exception as e:
-        print(f"Errore nel salvataggio del file .txt: {e}")
-        return False
+def verify_telegram_chat(chat_id):
+    """Verifica la connessione Telegram una sola volta per ogni chat"""
+    with verified_chats_lock:
+        if chat_id in verified_chats:
+            return
+        verified_chats.add(chat_id)
+    test_telegram_connection(chat_id)
 
-def fetch_and_save():
-    global primo_avvio, check_counter, updates_since_last_send
+def extract_positions(vehicle_info):
+    """Estrae dalla risposta tutte le posizioni recenti in ordine cronologico (almeno lastPosition)"""
+    positions = []
+    for key in ("recentPositions", "positions", "items"):
+        if isinstance(vehicle_info.get(key), list):
+            positions = list(vehicle_info[key])
+            break
+    last_position = vehicle_info.get("lastPosition")
+    if last_position:
+        positions.append(last_position)
+        
+    # Rimuove i duplicati (lastPosition di solito è anche nella lista) e le posizioni incomplete
+    unique = {}
+    for position in positions:
+        if not isinstance(position, dict) or position.get("lat") is None or position.get("lng") is None or not position.get("timestamp"):
+            continue
+        unique[(position["lat"], position["lng"], position["timestamp"])] = position
+    return sorted(unique.values(), key=lambda position: position["timestamp"])
+
+def build_position(raw_position, vehicle_info, geocode=True):
+    """Crea la riga dell'archivio da una posizione dell'API, completando l'indirizzo se serve
+    (con geocode=False resta l'indirizzo inviato da Targa, completato poi da fill_missing_addresses)"""
+    # Se l'indirizzo è già presente nella risposta, lo usiamo
+    via = raw_position.get('street', '')
+    comune = raw_position.get('city', '')
+    provincia = raw_position.get('prov', '')
+    
+    # Se non ci sono abbastanza informazioni, usiamo il geocoding
+    if geocode and not (via and comune and provincia):
+        print("Informazioni sull'indirizzo incomplete, richiedo geocoding")
+        address_info = get_address(raw_position["lat"], raw_position["lng"])
+        via = via or address_info['via']
+        comune = comune or address_info['comune']
+        provincia = provincia or address_info['provincia']
+        
+    return {
+        "timestamp": raw_position["timestamp"],
+        "lat": raw_position["lat"],
+        "lon": raw_position["lng"],
+        "speed": raw_position.get("speed", 0),
+        # Batteria e chilometraggio della singola posizione se presenti, altrimenti quelli attuali del veicolo
+        "mileage": raw_position.get("mileage", vehicle_info.get("mileage", 0)),
+        "description": raw_position.get("type", "N/A"),
+        "battery": raw_position.get("batteryLevel", vehicle_info.get("batteryLevel", "N/A")),
+        "fix": raw_position.get("type", "N/A"),
+        "hdop": raw_position.get("accuracy", 0),
+        "via": via,
+        "comune": comune,
+        "provincia": provincia
+    }
+
+def fill_missing_addresses(unit, limit=ADDRESS_BACKFILL_LIMIT, budget=ADDRESS_BACKFILL_SECONDS):
+    """Completa con il geocoding l'indirizzo delle posizioni salvate senza, in ordine di arrivo,
+    al massimo limit per volta ed entro budget secondi; il punto raggiunto è salvato in tracker_state.db"""
+    deadline = time.monotonic() + budget
+    checkpoint_key = f"address_seq:{unit.unit_id}"
+    checkpoint = get_state_value(checkpoint_key, 0)
+    with unit.db_lock:
+        rows = get_db(unit).execute(
+            "SELECT rowid, timestamp, lat, lon, via, comune, provincia FROM positions WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (checkpoint, max(limit, 1) * 20)
+        ).fetchall()
+    
+    filled = []
+    for seq, timestamp, lat, lon, via, comune, provincia in rows:
+        if not (via and comune and provincia):
+            # Le posizioni rimaste vengono completate al prossimo ciclo
+            if len(filled) >= limit or time.monotonic() >= deadline:
+                break
+            address_info = get_address(lat, lon)
+            filled.append((seq, timestamp, lat, lon, {
+                "via": via or address_info['via'],
+                "comune": comune or address_info['comune'],
+                "provincia": provincia or address_info['provincia']
+            }))
+        checkpoint = seq
     
+    if filled:
+        with unit.db_lock:
+            conn = get_db(unit)
+            conn.executemany(
+                "UPDATE positions SET via = ?, comune = ?, provincia = ? WHERE rowid = ?",
+                [(address["via"], address["comune"], address["provincia"], seq) for seq, _, _, _, address in filled]
+            )
+            conn.commit()
+        # Anche le posizioni recenti in memoria (etichette delle mappe) ricevono l'indirizzo
+        addresses = {(timestamp, lat, lon): address for _, timestamp, lat, lon, address in filled}
+        with unit.recent_positions_lock:
+            for position in unit.recent_positions:
+                address = addresses.get((position["timestamp"], position["lat"], position["lon"]))
+                if address is not None:
+                    position.update(address)
+        # I giorni già copiati nello storico Parquet vengono riscritti con gli indirizzi completati
+        history_seq = get_state_value(f"history_seq:{unit.unit_id}", 0)
+        with unit.history_lock:
+            for day in sorted({str(timestamp)[:10] for seq, timestamp, _, _, _ in filled if seq <= history_seq}):
+                write_history_partition(unit, day)
+        print(f"[{unit.name}] Indirizzo completato per {len(filled)} posizioni")
+    set_state_value(checkpoint_key, checkpoint)
+    return len(filled)
+
+def fetch_and_save(unit):
+    # Un solo check alla volta per lo stesso veicolo
+    if not unit.poll_lock.acquire(blocking=False):
+        print(f"[{unit.name}] Check già in corso, salto")
+        return None
+        
     try:
         # Verifica connessione Telegram solo al primo avvio
-        if primo_avvio:
+        if unit.primo_avvio:
             print("Primo avvio - Verifico connessione Telegram...")
-            test_telegram_connection()
-            primo_avvio = False
+            verify_telegram_chat(unit.chat_id)
+            unit.primo_avvio = False
             
         # Incrementa il contatore di check
-        check_counter += 1
-        print(f"\n[{datetime.now()}] Esecuzione check #{check_counter}")
+        unit.check_counter += 1
+        print(f"\n[{datetime.now()}] [{unit.name}] Esecuzione check #{unit.check_counter}")
             
         # Parametri della richiesta
         params = {
@@ -1146,156 +3194,532 @@ def fetch_and_save():
             "limit": 25
         }
 
-        # Utilizziamo una sessione per gestire meglio le richieste HTTP
-        session = requests.Session()
-        response = session.get(base_url, headers=headers, params=params)
+        # Sessione condivisa: le connessioni HTTP vengono riutilizzate tra check e veicoli
+        response = targa_session.get(unit.base_url, headers=unit.headers, params=params, timeout=30)
         print(f"Status code: {response.status_code}")
         
         if response.status_code == 401:
             print("Errore: Token non valido o scaduto. Aggiorna il token di autorizzazione.")
-            return
+            return None
             
         response.raise_for_status()
         data = response.json()
         
-        # Otteniamo l'ultima posizione invece dell'array di posizioni
-        last_position = data["data"]["lastPosition"]
-        print("Ottenuta l'ultima posizione del veicolo:")
-        print(f"Coordinate: {last_position['lat']}, {last_position['lng']}")
-        print(f"Timestamp: {last_position['timestamp']}")
-        print(f"Indirizzo: {last_position.get('formatted_address', 'Non disponibile')}")
-        
-        # Carica i dati esistenti se il file CSV esiste
-        try:
-            existing_df = pd.read_csv(csv_file)
-            print(f"Trovate {len(existing_df)} posizioni esistenti")
-        except FileNotFoundError:
-            existing_df = pd.DataFrame()
-            print("Nessun file CSV esistente trovato")
-
-        # Verifica se questa posizione con lo stesso timestamp esiste già
-        is_existing = False
-        if not existing_df.empty:
-            existing_pos = existing_df[
-                (existing_df['lat'] == last_position['lat']) & 
-                (existing_df['lon'] == last_position['lng']) &
-                (existing_df['timestamp'] == last_position['timestamp'])
-            ]
-            if not existing_pos.empty:
-                print("Posizione con le stesse coordinate e timestamp già registrata, nessun aggiornamento necessario")
-                
-                # Inviamo i file ogni 12 check (circa 60 minuti) se ci sono stati aggiornamenti
-                if check_counter % 12 == 0:
-                    print("È arrivato il momento di inviare i file aggiornati (ogni 60 minuti)")
-                    send_telegram_files()
-                    
-                # Controlla se ci sono callback queries da processare
-                check_and_process_updates()
-                
-                return
-                
-        # Estrazione dei dati interessanti
-        # Se l'indirizzo è già presente nel formatted_address, lo usiamo
-        formatted_address = last_position.get('formatted_address', '')
-        via = last_position.get('street', '')
-        comune = last_position.get('city', '')
-        provincia = last_position.get('prov', '')
-        
-        # Se non ci sono abbastanza informazioni, usiamo il geocoding
-        if not (via and comune and provincia):
-            print("Informazioni sull'indirizzo incomplete, richiedo geocoding")
-            address_info = get_address(last_position["lat"], last_position["lng"])
-            via = via or address_info['via']
-            comune = comune or address_info['comune']
-            provincia = provincia or address_info['provincia']
-        
-        # Creiamo una nuova posizione da salvare
-        # Estraiamo informazioni aggiuntive dal veicolo
+        # Tutte le posizioni della risposta, non solo l'ultima
         vehicle_info = data["data"]
-        battery = vehicle_info.get("batteryLevel", "N/A")
-        mileage = vehicle_info.get("mileage", 0)
-        
-        # Creiamo la riga da aggiungere
-        new_position = {
-            "timestamp": last_position["timestamp"],
-            "lat": last_position["lat"],
-            "lon": last_position["lng"],
-            "speed": last_position["speed"],
-            "mileage": mileage,
-            "description": last_position.get("type", "N/A"),
-            "battery": battery,
-            "fix": last_position.get("type", "N/A"),
-            "hdop": last_position.get("accuracy", 0),
-            "via": via,
-            "comune": comune,
-            "provincia": provincia
-        }
+        raw_positions = extract_positions(vehicle_info)
+        print(f"Ottenute {len(raw_positions)} posizioni del veicolo")
+        if not raw_positions:
+            return None
+        last_position = raw_positions[-1]
+        print(f"Ultima posizione: {last_position['lat']}, {last_position['lng']} ({last_position['timestamp']})")
+        
+        # Una sola query sull'archivio per scartare quelle già registrate
+        new_raw_positions = filter_new_positions(unit, [
+            {"lat": raw["lat"], "lon": raw["lng"], "timestamp": raw["timestamp"], "raw": raw}
+            for raw in raw_positions
+        ])
+        if not new_raw_positions:
+            print("Nessuna nuova posizione rispetto all'archivio, nessun aggiornamento necessario")
+            return None
+            
+        # Completa le nuove posizioni e le aggiunge all'archivio in un'unica transazione: il geocoding
+        # (limitato a 1/s per tutta la flotta) solo per la più recente, l'unica notificata;
+        # le altre tengono l'indirizzo di Targa e vengono completate all'invio dei file
+        new_positions = [
+            build_position(item["raw"], vehicle_info, geocode=index == len(new_raw_positions) - 1)
+            for index, item in enumerate(new_raw_positions)
+        ]
+        # Inserimento e buffer sotto lo stesso lock: l'istantanea li legge sempre allineati
+        with unit.db_lock:
+            inserted = insert_positions(unit, new_positions)
+            for position in inserted:
+                add_recent_position(unit, position)
+        if not inserted:
+            return None
+        # Aggiorna i viaggi solo con le nuove posizioni
+        try:
+            update_trips(unit)
+        except Exception as e:
+            print(f"[{unit.name}] Errore nella segmentazione dei viaggi: {e}")
+        print(f"\n[{datetime.now()}] Dati aggiornati, {len(inserted)} nuove posizioni salvate.")
         
-        # Creiamo un DataFrame con la nuova posizione
-        new_df = pd.DataFrame([new_position])
+        # La notifica riguarda la posizione più recente del blocco
+        return inserted[-1]
         
-        # Unisci i dati esistenti con i nuovi
-        if not existing_df.empty:
-            merged_df = pd.concat([existing_df, new_df])
-            # Rimuovi duplicati basati su lat, lon E timestamp
-            merged_df.drop_duplicates(subset=['lat', 'lon', 'timestamp'], keep='last', inplace=True)
-        else:
-            merged_df = new_df
+    except requests.exceptions.RequestException as e:
+        print(f"[{unit.name}] Errore nella richiesta: {e}")
+    except Exception as e:
+        print(f"[{unit.name}] Errore imprevisto: {e}")
+    finally:
+        unit.poll_lock.release()
+    return None
 
-        # Ordina il DataFrame per timestamp in ordine decrescente (più recenti prima)
-        merged_df = merged_df.sort_values(by='timestamp', ascending=False)
-            
-        # Salva il CSV con l'encoding UTF-8
-        merged_df.to_csv(csv_file, index=False, encoding="utf-8")
-        print(f"\n[{datetime.now()}] Dati aggiornati, nuova posizione salvata.")
-        
-        # Salva anche in formato .txt
-        if save_to_txt(merged_df):
-            # Segnala che ci sono stati aggiornamenti
-            updates_since_last_send = True
-            
+def notify_position(unit, position):
+    """Genera le mappe e invia su Telegram l'aggiornamento di una nuova posizione"""
+    try:
         # Genera preventivamente le mappe di percorso se ci sono abbastanza posizioni
-        generate_route_maps_if_needed()
+        generate_route_maps_if_needed(unit)
         
         # Crea l'indirizzo formattato per il messaggio
-        address_for_message = get_formatted_address(via, comune, provincia)
+        address_for_message = get_formatted_address(position["via"], position["comune"], position["provincia"])
         
         # Invia un messaggio con la posizione attuale e la mappa
-        send_position_update(
-            last_position["lat"], 
-            last_position["lng"], 
+        return send_position_update(
+            unit,
+            position["lat"], 
+            position["lon"], 
             address_for_message,
-            last_position["timestamp"], 
-            last_position["speed"],
-            battery
+            position["timestamp"], 
+            position["speed"],
+            position["battery"]
         )
-        
-        # Inviamo i file ogni 12 check (circa 60 minuti) se ci sono stati aggiornamenti
-        if check_counter % 12 == 0:
-            print("È arrivato il momento di inviare i file aggiornati (ogni 60 minuti)")
-            send_telegram_files()
+    except Exception as e:
+        print(f"[{unit.name}] Errore nell'invio dell'aggiornamento: {e}")
+        return False
+
+async def run_in(executor, func, *args):
+    """Esegue una funzione bloccante nel pool di thread indicato senza bloccare l'event loop"""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+def log_task_error(task):
+    """Stampa l'errore di un task in background terminato con un'eccezione"""
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Errore in un task in background: {task.exception()}")
+
+def spawn(coroutine):
+    """Avvia un task indipendente, tenendone un riferimento finché non termina"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(log_task_error)
+    return task
+
+def find_runs(mask):
+    """Inizio e fine (esclusa) di ogni sequenza di True in un array booleano"""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(np.int8), [0]))))
+    return edges[0::2], edges[1::2]
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    """Distanze in metri tra coppie di coordinate (array NumPy)"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def track_intervals(track):
+    """Grandezze di ogni intervallo tra due posizioni consecutive, calcolate in blocco:
+    distanza (m), tempo trascorso (s), movimento e pausa senza posizioni"""
+    ts, lat, lon, speed = track["ts"], track["lat"], track["lon"], track["speed"]
+    distance = haversine_array(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    elapsed = np.diff(ts) / 1000.0
+    implied_speed = np.where(elapsed > 0, distance / np.maximum(elapsed, 1e-3) * 3.6, 0)
+    moving = (implied_speed > STATIONARY_SPEED_KMH) | (np.nan_to_num(speed[1:]) > STATIONARY_SPEED_KMH)
+    gap = elapsed > TRIP_GAP_SECONDS
+    return distance, elapsed, moving, gap
+
+def segment_trips(track):
+    """Divide una traccia (array ts in ms, lat, lon, speed in ordine cronologico) in viaggi e soste.
+    
+    Restituisce gli indici (inizio, fine) delle posizioni di ogni viaggio: un viaggio termina con una sosta
+    di almeno TRIP_STOP_MIN_SECONDS o con una pausa tra due posizioni oltre TRIP_GAP_SECONDS.
+    """
+    if len(track["ts"]) < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    distance, elapsed, moving, gap = track_intervals(track)
+    
+    # Soste: sequenze di intervalli da fermo abbastanza lunghe, più le pause senza posizioni
+    elapsed_total = np.concatenate(([0], np.cumsum(elapsed)))
+    starts, ends = find_runs(~moving & ~gap)
+    long_runs = (elapsed_total[ends] - elapsed_total[starts]) >= TRIP_STOP_MIN_SECONDS
+    marks = np.zeros(len(elapsed) + 1, dtype=np.int64)
+    np.add.at(marks, starts[long_runs], 1)
+    np.add.at(marks, ends[long_runs], -1)
+    stopped = (np.cumsum(marks)[:-1] > 0) | gap
+    
+    # Viaggi: sequenze di intervalli fuori dalle soste, scartando gli spostamenti troppo brevi
+    trip_starts, trip_ends = find_runs(~stopped)
+    distance_total = np.concatenate(([0], np.cumsum(distance)))
+    long_enough = (distance_total[trip_ends] - distance_total[trip_starts]) >= TRIP_MIN_DISTANCE_M
+    return trip_starts[long_enough], trip_ends[long_enough]
+
+def summarize_trips(track, trip_starts, trip_ends):
+    """Riepilogo di ogni viaggio (orari, distanza, durata, velocità) a partire dagli indici delle posizioni"""
+    if len(trip_starts) == 0:
+        return []
+    ts, lat, lon = track["ts"], track["lat"], track["lon"]
+    distance = haversine_array(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    distance_total = np.concatenate(([0], np.cumsum(distance)))
+    trip_distance = distance_total[trip_ends] - distance_total[trip_starts]
+    duration = (ts[trip_ends] - ts[trip_starts]) / 1000.0
+    # Velocità massima riportata su ciascun viaggio (reduceat su segmenti [inizio, fine])
+    bounds = np.column_stack((trip_starts, trip_ends + 1)).ravel()
+    speed = np.concatenate((np.nan_to_num(track["speed"]), [0]))
+    max_speed = np.maximum.reduceat(speed, bounds)[0::2]
+    return [
+        {
+            "start_timestamp": track["timestamp"][start],
+            "end_timestamp": track["timestamp"][end],
+            "start": [float(lat[start]), float(lon[start])],
+            "end": [float(lat[end]), float(lon[end])],
+            "distance_m": float(trip_distance[i]),
+            "duration_s": float(duration[i]),
+            "avg_speed": float(trip_distance[i] / duration[i] * 3.6) if duration[i] > 0 else 0.0,
+            "max_speed": float(max_speed[i]),
+            "positions": int(end - start + 1)
+        }
+        for i, (start, end) in enumerate(zip(trip_starts, trip_ends))
+    ]
+
+def load_track(unit, since_seq=0):
+    """Posizioni aggiunte dopo since_seq come array NumPy (timestamp in ms), più il nuovo numero progressivo"""
+    with unit.db_lock:
+        df = pd.read_sql_query(
+            "SELECT rowid AS seq, timestamp, lat, lon, speed FROM positions WHERE rowid > ?",
+            get_db(unit),
+            params=(int(since_seq),)
+        )
+    last_seq = int(df["seq"].max()) if len(df) else since_seq
+    ts = pd.to_datetime(df["timestamp"], utc=True, errors="coerce", format="mixed")
+    valid = ts.notna().to_numpy()
+    return {
+        "ts": (ts[valid].astype("int64") // 1_000_000).to_numpy(dtype=np.int64),
+        "timestamp": df["timestamp"][valid].astype(str).to_numpy(dtype=object),
+        "lat": pd.to_numeric(df["lat"][valid], errors="coerce").to_numpy(dtype=np.float64),
+        "lon": pd.to_numeric(df["lon"][valid], errors="coerce").to_numpy(dtype=np.float64),
+        "speed": pd.to_numeric(df["speed"][valid], errors="coerce").to_numpy(dtype=np.float64)
+    }, last_seq
+
+def trim_parked_tail(tail):
+    """Con il veicolo fermo la coda si riduce all'ultima sosta di TRIP_STOP_MIN_SECONDS: le posizioni
+    precedenti non possono più entrare in un viaggio, e la coda non cresce per tutta la durata della sosta"""
+    ts = tail["ts"]
+    # Prima posizione da tenere: l'ultima che precede la finestra, così la sosta tenuta dura almeno TRIP_STOP_MIN_SECONDS
+    first = int(np.searchsorted(ts, ts[-1] - TRIP_STOP_MIN_SECONDS * 1000, side="right")) - 1 if len(ts) else 0
+    if first <= 0:
+        return tail
+    # Nessun viaggio in corso nella coda e nessun movimento nella finestra tenuta
+    trip_starts, _ = segment_trips(tail)
+    _, _, moving, _ = track_intervals({key: values[first:] for key, values in tail.items()})
+    if len(trip_starts) or moving.any():
+        return tail
+    return {key: values[first:] for key, values in tail.items()}
+
+def update_trips(unit):
+    """Segmentazione incrementale: rielabora solo le posizioni dopo l'ultimo viaggio concluso"""
+    with unit.trips_lock:
+        new_track, last_seq = load_track(unit, unit.trip_seq)
+        if last_seq == unit.trip_seq and unit.trip_tail is not None:
+            return
+        unit.trip_seq = last_seq
+        
+        # Coda = posizioni non ancora assegnate a un viaggio concluso, più le nuove, in ordine cronologico
+        if unit.trip_tail is not None:
+            new_track = {key: np.concatenate((unit.trip_tail[key], new_track[key])) for key in new_track}
+        order = np.argsort(new_track["ts"], kind="stable")
+        track = {key: values[order] for key, values in new_track.items()}
+        
+        trip_starts, trip_ends = segment_trips(track)
+        # Un viaggio è concluso se dopo la sua ultima posizione è già iniziata una sosta
+        closed = trip_ends < len(track["ts"]) - 1
+        unit.trips.extend(summarize_trips(track, trip_starts[closed], trip_ends[closed]))
+        cut = int(trip_ends[closed][-1]) if closed.any() else 0
+        unit.trip_tail = trim_parked_tail({key: values[cut:] for key, values in track.items()})
+
+def get_trips(unit, day=None):
+    """Viaggi conclusi più quello eventualmente in corso (ultimo, con "ongoing"), filtrati per giorno AAAA-MM-GG"""
+    update_trips(unit)
+    with unit.trips_lock:
+        trips = list(unit.trips)
+        tail = unit.trip_tail
+        trip_starts, trip_ends = segment_trips(tail)
+        ongoing = summarize_trips(tail, trip_starts, trip_ends)
+    for trip in ongoing:
+        trip["ongoing"] = True
+    trips.extend(ongoing)
+    if day is not None:
+        trips = [trip for trip in trips if str(trip["start_timestamp"])[:10] == day]
+    return trips
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Distanza in metri tra due coordinate"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (float(lat1), float(lon1), float(lat2), float(lon2)))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def is_moving(unit, position):
+    """Il veicolo è in movimento se la velocità o lo spostamento dall'ultima posizione superano le soglie"""
+    try:
+        if float(position.get("speed") or 0) > STATIONARY_SPEED_KMH:
+            return True
+    except (TypeError, ValueError):
+        pass
+    reference = unit.motion_reference
+    if reference is None:
+        return True
+    return haversine_m(reference["lat"], reference["lon"], position["lat"], position["lon"]) > STATIONARY_DISTANCE_M
+
+def next_poll_interval(unit, new_position):
+    """Polling adattivo: si stringe in movimento, raddoppia da fermo o se non ci sono novità"""
+    if new_position is not None and is_moving(unit, new_position):
+        # In movimento: torna subito all'intervallo base, poi si dimezza fino al minimo
+        interval = max(min(unit.poll_interval, POLL_INTERVAL_SECONDS) // 2, POLL_MIN_INTERVAL_SECONDS)
+        if unit.poll_interval > POLL_INTERVAL_SECONDS:
+            interval = max(POLL_INTERVAL_SECONDS, POLL_MIN_INTERVAL_SECONDS)
+    else:
+        interval = min(unit.poll_interval * 2, POLL_MAX_INTERVAL_SECONDS)
+    if new_position is not None:
+        unit.motion_reference = new_position
+        
+    if interval != unit.poll_interval:
+        print(f"[{unit.name}] Intervallo di polling: {unit.poll_interval}s -> {interval}s")
+    unit.poll_interval = interval
+    return interval
+
+def unit_snapshot(unit):
+    """Stato in memoria di un veicolo, serializzabile in JSON"""
+    # Numero progressivo e buffer letti sotto lo stesso lock di fetch_and_save (inserimento e
+    # aggiunta al buffer): ogni posizione fino a positions_seq è già nel buffer e nel conteggio
+    with unit.db_lock:
+        positions_seq = get_last_sequence(unit)
+        with unit.recent_positions_lock:
+            recent_positions = list(unit.recent_positions)
+            positions_count = unit.positions_count
+    with unit.trips_lock:
+        trips = list(unit.trips)
+        trip_tail = None
+        if unit.trip_tail is not None:
+            trip_tail = {key: values.tolist() for key, values in unit.trip_tail.items()}
+        trip_seq = unit.trip_seq
+    return {
+        # Numero progressivo a cui si riferiscono buffer e conteggio: al riavvio si legge solo quanto è venuto dopo
+        "positions_seq": positions_seq,
+        "positions_count": positions_count,
+        "recent_positions": recent_positions,
+        "check_counter": unit.check_counter,
+        "primo_avvio": unit.primo_avvio,
+        "poll_interval": unit.poll_interval,
+        "motion_reference": unit.motion_reference,
+        "next_files_send": unit.next_files_send,
+        "rendered_keys": dict(unit.rendered_keys),
+        "trips": trips,
+        "trip_tail": trip_tail,
+        "trip_seq": trip_seq
+    }
+
+def save_runtime_snapshot():
+    """Scrive l'istantanea di tutti i veicoli in modo atomico: file temporaneo, fsync e rinomina"""
+    try:
+        snapshot = {
+            "saved_at": time.time(),
+            "verified_chats": sorted(verified_chats, key=str),
+            "units": {unit_id: unit_snapshot(unit) for unit_id, unit in list(units.items())}
+        }
+        directory = os.path.dirname(os.path.abspath(RUNTIME_SNAPSHOT_FILE))
+        fd, temp_file = tempfile.mkstemp(dir=directory, prefix=".runtime_state_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, default=str)
+                f.flush()
+                os.fsync(f.fileno())
+            # Un crash durante la scrittura lascia intatta l'istantanea precedente
+            os.replace(temp_file, RUNTIME_SNAPSHOT_FILE)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+        return True
+    except Exception as e:
+        print(f"Errore nel salvataggio dell'istantanea dello stato: {e}")
+        return False
+
+def load_runtime_snapshot():
+    """Legge l'ultima istantanea salvata (dizionario vuoto se manca o non è leggibile)"""
+    try:
+        with open(RUNTIME_SNAPSHOT_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Istantanea dello stato non leggibile, avvio a freddo: {e}")
+        return {}
+
+def restore_unit_snapshot(unit, state):
+    """Riavvio a caldo di un veicolo: ripristina lo stato e legge dall'archivio solo le posizioni successive"""
+    if not state:
+        return False
+    try:
+        snapshot_seq = int(state["positions_seq"])
+        last_seq = get_last_sequence(unit)
+        if snapshot_seq > last_seq:
+            # L'archivio è più vecchio dell'istantanea (es. ripristinato da backup): non è affidabile
+            print(f"[{unit.name}] Istantanea più recente dell'archivio, avvio a freddo")
+            return False
+        new_positions = load_positions(unit, since_seq=snapshot_seq).iloc[::-1].astype(object)
+        new_positions = new_positions.where(pd.notna(new_positions), None).to_dict("records")
+        
+        with unit.recent_positions_lock:
+            unit.recent_positions.clear()
+            unit.recent_positions.extend(state["recent_positions"])
+            unit.positions_count = int(state["positions_count"])
+        for position in new_positions:
+            add_recent_position(unit, position)
             
-        # Controlla se ci sono callback queries da processare
-        check_and_process_updates()
-        
-    except requests.exceptions.RequestException as e:
-        print(f"Errore nella richiesta: {e}")
+        unit.check_counter = int(state["check_counter"])
+        unit.primo_avvio = bool(state["primo_avvio"])
+        unit.poll_interval = min(max(int(state["poll_interval"]), POLL_MIN_INTERVAL_SECONDS), POLL_MAX_INTERVAL_SECONDS)
+        unit.motion_reference = state["motion_reference"]
+        unit.next_files_send = state["next_files_send"]
+        # Le chiavi valgono solo se il file corrispondente esiste ancora
+        unit.rendered_keys = {path: key for path, key in state["rendered_keys"].items() if os.path.exists(path)}
+        with unit.trips_lock:
+            unit.trips.clear()
+            unit.trips.extend(state["trips"])
+            unit.trip_seq = int(state["trip_seq"])
+            unit.trip_tail = None
+            if state["trip_tail"] is not None:
+                tail = state["trip_tail"]
+                unit.trip_tail = {
+                    "ts": np.asarray(tail["ts"], dtype=np.int64),
+                    "timestamp": np.asarray(tail["timestamp"], dtype=object),
+                    "lat": np.asarray(tail["lat"], dtype=np.float64),
+                    "lon": np.asarray(tail["lon"], dtype=np.float64),
+                    "speed": np.asarray(tail["speed"], dtype=np.float64)
+                }
+        print(f"[{unit.name}] Stato ripristinato dall'istantanea ({len(new_positions)} posizioni successive, {unit.positions_count} in archivio)")
+        return True
     except Exception as e:
-        print(f"Errore imprevisto: {e}")
-    finally:
-        if 'session' in locals():
-            session.close()
+        print(f"[{unit.name}] Errore nel ripristino dell'istantanea, avvio a freddo: {e}")
+        return False
+
+async def snapshot_loop():
+    """Task dell'istantanea: salva lo stato in memoria ogni SNAPSHOT_INTERVAL_SECONDS"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL_SECONDS)
+        await run_in(notify_executor, save_runtime_snapshot)
+
+def log_runtime_stats():
+    """Stampa nel log le statistiche di servizio accumulate dall'avvio"""
+    metrics = get_render_metrics()
+    print(
+        f"Statistiche rendering: {metrics['renders']} mappe, attesa tile media {metrics['wait_avg']:.2f}s "
+        f"(max {metrics['wait_max']:.2f}s, ultima {metrics['wait_last']:.2f}s), {metrics['timeouts']} timeout"
+    )
+    tiles = get_tile_cache_stats()
+    requests_total = tiles["hits"] + tiles["misses"]
+    hit_ratio = tiles["hits"] / requests_total if requests_total else 0.0
+    print(
+        f"Statistiche cache tile: {tiles['hits']} hit, {tiles['misses']} miss ({hit_ratio:.0%} hit), "
+        f"{tiles['evictions']} evizioni, {tiles['errors']} errori, {tiles['size_bytes'] / 1048576:.1f} MB"
+    )
+
+async def stats_loop():
+    """Task delle statistiche: le stampa ogni STATS_INTERVAL_SECONDS"""
+    while True:
+        await asyncio.sleep(STATS_INTERVAL_SECONDS)
+        log_runtime_stats()
+
+async def unit_poll_loop(unit, start_delay):
+    """Task di un veicolo: check con intervallo adattivo, con l'invio delle notifiche in un task separato"""
+    await asyncio.sleep(start_delay)
+    while True:
+        new_position = await run_in(fleet_executor, fetch_and_save, unit)
+        if new_position is not None:
+            # Rendering e invio non ritardano il prossimo check
+            spawn(run_in(notify_executor, notify_position, unit, new_position))
+        await asyncio.sleep(next_poll_interval(unit, new_position))
 
-# Pianifica ogni 5 minuti
-schedule.every(5).minutes.do(fetch_and_save)
+async def unit_files_loop(unit, start_delay=0):
+    """Task di un veicolo: invio dei file di riepilogo ogni FILES_INTERVAL_SECONDS"""
+    while True:
+        # Dopo un riavvio a caldo la cadenza prosegue da dove si era fermata
+        if unit.next_files_send is None:
+            unit.next_files_send = time.time() + FILES_INTERVAL_SECONDS + start_delay
+        await asyncio.sleep(max(unit.next_files_send - time.time(), 0))
+        unit.next_files_send = time.time() + FILES_INTERVAL_SECONDS
+        print(f"[{unit.name}] È arrivato il momento di inviare i file aggiornati")
+        # Un errore resta confinato a questo ciclo del veicolo: gli altri task continuano
+        try:
+            # Prima dell'esportazione, gli indirizzi delle posizioni salvate senza geocoding
+            await run_in(address_executor, fill_missing_addresses, unit)
+            await run_in(notify_executor, send_telegram_files, unit)
+            # Lo storico Parquet segue l'archivio a ogni ciclo, così le query non devono attendere
+            await run_in(notify_executor, sync_history, unit)
+        except Exception as e:
+            print(f"[{unit.name}] Errore nel ciclo di invio dei file: {e}")
 
-# Pianifica il controllo degli aggiornamenti Telegram ogni 30 secondi
-schedule.every(30).seconds.do(check_and_process_updates)
+async def telegram_updates_loop():
+    """Task dei pulsanti: long polling con offset persistente, ogni aggiornamento in un task separato"""
+    # getUpdates non funziona finché è registrato un webhook (es. da un avvio precedente in modalità webhook)
+    try:
+        await run_in(updates_executor, telegram.request, "deleteWebhook")
+    except Exception as e:
+        print(f"Errore nella rimozione del webhook: {e}")
+    offset = await run_in(updates_executor, get_state_value, "telegram_offset", 0)
+    # Aggiornamenti rimasti a metà alla chiusura precedente: Telegram li ha già confermati, si rielaborano da qui
+    pending = await run_in(updates_executor, get_state_value, "telegram_pending", [])
+    if pending:
+        print(f"Ripresa di {len(pending)} aggiornamenti Telegram non completati")
+        await run_in(updates_executor, begin_updates, pending)
+        for update in pending:
+            spawn(run_in(callback_executor, process_update, update))
+        offset = max(offset, max(update["update_id"] for update in pending) + 1)
+    backoff = 1
+    while True:
+        try:
+            updates = await run_in(updates_executor, get_telegram_updates, offset)
+        except Exception as e:
+            # Attesa esponenziale: un errore persistente non diventa un ciclo di richieste continue
+            print(f"Errore nel controllo degli aggiornamenti Telegram (nuovo tentativo tra {backoff}s): {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, TELEGRAM_UPDATES_MAX_BACKOFF)
+            continue
+        backoff = 1
+            
+        if not updates:
+            continue
+            
+        # Il blocco viene salvato prima della prossima getUpdates (che lo conferma a Telegram):
+        # un riavvio riprende gli aggiornamenti non ancora gestiti invece di perderli
+        updates = sorted(updates, key=lambda update: update["update_id"])
+        await run_in(updates_executor, begin_updates, updates)
+        # Ogni aggiornamento in un task separato, nell'ordine in cui sono arrivati:
+        # un rendering lento non ritarda gli altri pulsanti né la prossima richiesta
+        for update in updates:
+            spawn(run_in(callback_executor, process_update, update))
+        offset = updates[-1]["update_id"] + 1
 
-# Avvio ciclo
-print("Inizio monitoraggio veicolo ogni 5 minuti...")
-fetch_and_save()  # Primo fetch subito
+async def main():
+    # Carica i veicoli da monitorare e le loro posizioni recenti
+    load_units()
+    # Riavvio a caldo: si riparte dall'ultima istantanea, l'archivio si rilegge solo per i veicoli senza
+    snapshot = load_runtime_snapshot()
+    with verified_chats_lock:
+        verified_chats.update(snapshot.get("verified_chats", []))
+    for unit in units.values():
+        if not restore_unit_snapshot(unit, snapshot.get("units", {}).get(unit.unit_id)):
+            init_recent_positions(unit)  # Carica in memoria le posizioni recenti una sola volta
+    # L'ultima istantanea viene scritta anche all'uscita
+    atexit.register(save_runtime_snapshot)
+    # I pulsanti dei messaggi precedenti restano validi: si eliminano solo quelli scaduti
+    purge_callbacks()
+        
+    print(f"Inizio monitoraggio di {len(units)} veicoli (check ogni {POLL_MIN_INTERVAL_SECONDS}-{POLL_MAX_INTERVAL_SECONDS} secondi in base al movimento)...")
+    tasks = []
+    if TELEGRAM_UPDATES_MODE == "webhook":
+        # I pulsanti arrivano direttamente da Telegram: nessuna richiesta finché nessuno li preme
+        await run_in(updates_executor, start_webhook_server)
+    else:
+        tasks.append(asyncio.create_task(telegram_updates_loop()))
+    tasks.append(asyncio.create_task(snapshot_loop()))
+    if STATS_INTERVAL_SECONDS > 0:
+        tasks.append(asyncio.create_task(stats_loop()))
+    for index, unit in enumerate(units.values()):
+        # I check dei veicoli vengono distribuiti lungo l'intervallo (il primo parte subito)
+        start_delay = index * POLL_INTERVAL_SECONDS / len(units)
+        tasks.append(asyncio.create_task(unit_poll_loop(unit, start_delay)))
+        # Anche gli invii dei file vengono distribuiti lungo il loro intervallo
+        files_delay = index * FILES_INTERVAL_SECONDS / len(units)
+        tasks.append(asyncio.create_task(unit_files_loop(unit, files_delay)))
+    await asyncio.gather(*tasks)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())